@@ -1,94 +1,159 @@
+import time
+# how long the app takes to be ready is reported once it is
+import_started = time.perf_counter()
+import sys
+import gc
 import datetime as dt
 import dash
 from dash import dcc, html, dash_table, ctx
 from dash.dependencies import Input, Output, State
+from dash.exceptions import PreventUpdate
 import pandas as pd
 import math
-import plotly.express as px
 import requests as req
 import json
-import io
+import gzip
+import gist_client
+import gist_storage
+import store
+import ingest
+import mirror
+import downsample
+import figure_cache
+import singleflight
+import export
+import query
+import metrics
 from flask_restful import Api, Resource
-from flask import request
-# store credentials in a file called cred.py in root folder
-import cred
-
-log_activity = False
-
-def log_message(msg):
-    if log_activity:
-        with open('log.txt', 'a') as f:
-            f.write(str(dt.datetime.now()) + ': ' + msg + '\n')
-
-def load_manual_readings():
-    log_message('load_manual_readings start')
-    # get latest version of data from gist
-    gist_response = req.get(url='https://api.github.com/gists/e7c8598e3ba54bf86f0586c745026918',
-    headers= dict([('Accept', 'application/vnd.github+json'),
-        ('Authorization', 'Bearer ' + cred.github_pat),
-        ('X-GitHub-Api-Version', '2022-11-28')])) 
-        
-    content = gist_response.json()['files']['manual_readings.csv']['content']
-
-    csv = pd.read_csv(io.StringIO(content))
-    log_message('load_manual_readings end')
-    return csv
+from flask import request, Response
 
-def save_manual_readings(data):
-    log_message('save_manual_readings start')
-    payload = {'files': {'manual_readings.csv':{'content':data.to_csv(index=False)}}}
+def load_manual_readings(start=None, end=None):
+    # get latest version of data from gist, only reading the months between start and end
+    # (served from the local cache while it is still current)
+    with metrics.span('gist_load', table='manual_readings'):
+        csv = gist_storage.load_readings(gist_client.manual_gist_id, 'manual_readings', start, end)
+    return csv
 
-    req.patch(url = 'https://api.github.com/gists/e7c8598e3ba54bf86f0586c745026918',
-    headers = dict([('Accept', 'application/vnd.github+json'),
-        ('Authorization', 'Bearer ' + cred.github_pat),
-        ('X-GitHub-Api-Version', '2022-11-28')]),
-        data = json.dumps(payload))
-    log_message('save_manual_readings end')
+def save_manual_readings(partitions):
+    with metrics.span('gist_save', table='manual_readings'):
+        gist_storage.save_readings(gist_client.manual_gist_id, 'manual_readings', partitions)
     return True
 
-def load_enviro_readings():
-    log_message('load_enviro_readings start')
-    # get latest version of data from gist
-    gist_response = req.get(url='https://api.github.com/gists/b961b551f676f0e7511cfccd475912e9',
-    headers= dict([('Accept', 'application/vnd.github+json'),
-        ('Authorization', 'Bearer ' + cred.github_pat),
-        ('X-GitHub-Api-Version', '2022-11-28')])) 
-        
-    content = gist_response.json()['files']['enviro_readings.csv']['content']
-    csv = pd.read_csv(io.StringIO(content))
-    log_message('load_enviro_readings end')
+def load_enviro_readings(start=None, end=None):
+    # get latest version of data from gist, only reading the months between start and end
+    # (served from the local cache while it is still current)
+    with metrics.span('gist_load', table='enviro_readings'):
+        csv = gist_storage.load_readings(gist_client.enviro_gist_id, 'enviro_readings', start, end)
     return csv
 
-def save_enviro_readings(data):
-    log_message('save_enviro_readings start')
-    payload = {'files': {'enviro_readings.csv':{'content':data.to_csv(index=False)}}}
-
-    req.patch(url = 'https://api.github.com/gists/b961b551f676f0e7511cfccd475912e9',
-    headers = dict([('Accept', 'application/vnd.github+json'),
-        ('Authorization', 'Bearer ' + cred.github_pat),
-        ('X-GitHub-Api-Version', '2022-11-28')]),
-        data = json.dumps(payload))
-    log_message('save_enviro_readings end')
+def save_enviro_readings(partitions):
+    with metrics.span('gist_save', table='enviro_readings'):
+        gist_storage.save_readings(gist_client.enviro_gist_id, 'enviro_readings', partitions)
     return True
 
-def combine_readings(manual, enviro):
-    manual['Method'] = 'Manual'
-    manual['Timestamp'] = pd.to_datetime(manual['Timestamp'], utc=True)
-    enviro.rename(columns={
-        'timestamp': 'Timestamp',
-        'temperature': 'Temperature',
-        'humidity': 'Humidity',
-        'pm1': 'PM1',
-        'pm2_5': 'PM2.5',
-        'pm10': 'PM10',
-        'pressure': 'Pressure',
-        'noise': 'Noise'
-        },
-        inplace=True)
-    enviro['Method'] = 'Enviro'
-    enviro['Timestamp'] = pd.to_datetime(enviro['Timestamp'], utc=True)
-    data = pd.concat([manual, enviro])   
-    return data
+def seed_store():
+    # the first time, fetch both gists at once rather than one after the other
+    loads = {'manual_readings': load_manual_readings, 'enviro_readings': load_enviro_readings}
+    unseeded = [name for name in loads if not store.is_seeded(name)]
+    if len(unseeded) > 1:
+        gist_client.fetch_concurrently([loads[name] for name in unseeded])
+    for name in unseeded:
+        store.ensure_seeded(name, loads[name])
+
+def read_manual_readings():
+    store.ensure_seeded('manual_readings', load_manual_readings)
+    return store.read_readings('manual_readings')
+
+def read_enviro_readings(start=None, end=None):
+    store.ensure_seeded('enviro_readings', load_enviro_readings)
+    return store.read_readings('enviro_readings', start, end)
+
+def store_time(value):
+    # timestamps are held in the store as utc iso strings; times without a zone are taken as utc
+    timestamp = pd.Timestamp(value)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.tz_localize('UTC')
+    return timestamp.tz_convert('UTC').strftime('%Y-%m-%dT%H:%M:%SZ')
+
+def read_combined_readings():
+    return query.combine_readings(read_manual_readings(), read_enviro_readings())
+
+def data_version():
+    # changes whenever either table in the store is written to
+    seed_store()
+    return str(store.data_version('manual_readings')) + '-' + str(store.data_version('enviro_readings'))
+
+def read_graph_readings():
+    # long histories are drawn from the hourly or daily rollups, as the lowest and highest
+    # reading in each bucket, so the figures cost the same however much data there is
+    if store.count_readings('enviro_readings') <= max_points_per_graph:
+        return read_combined_readings()
+    period, width = 'hour', dt.timedelta(hours=1)
+    if 2 * store.count_buckets('enviro_readings', period) > max_points_per_graph:
+        period, width = 'day', dt.timedelta(days=1)
+    rollups = store.read_rollups('enviro_readings', period)
+    enviro = pd.concat([rollups.pivot(index=['bucket', 'device'], columns='metric', values=stat)
+        for stat in ['min', 'max']])
+    enviro = enviro.rename_axis(columns=None).reset_index().rename(columns={'bucket': 'timestamp', 'device': 'uid'})
+    enviro['timestamp'] = pd.to_datetime(enviro['timestamp'], utc=True) + width / 2
+    return query.combine_readings(read_manual_readings(), enviro)
+
+_cached_readings = {}
+
+def live_position():
+    # each table's [version, newest row]; rows after it have not been read yet
+    with store.reading():
+        return {name: store.position(name) for name in store.tables}
+
+def get_cached_entry(key, read):
+    # built once per data version, and shared by all the graphs this worker draws; returns the
+    # readings and the live_position they were read at
+    version = data_version()
+    # callers wanting the same readings wait for the one reading them
+    with singleflight.thread_lock('readings-' + key):
+        if key not in _cached_readings or _cached_readings[key][0] != version:
+            metrics.count('cache_requests_total', cache=key, result='miss')
+            with store.reading():
+                _cached_readings[key] = (version, read(), live_position())
+        else:
+            metrics.count('cache_requests_total', cache=key, result='hit')
+        return _cached_readings[key][1:]
+
+def get_cached_readings(key, read):
+    return get_cached_entry(key, read)[0]
+
+def get_graph_readings():
+    return get_cached_readings('graph', read_graph_readings)
+
+def get_combined_readings():
+    # the raw readings in time order, for range lookups
+    return get_cached_readings('combined', read_combined_readings)
+
+def filter_devices(data, devices):
+    # devices is a list of kit uids, or None for all of them; manual readings are always kept
+    if devices is None:
+        return data
+    return data[(data['Method'] == 'Manual') | data['Device'].isin(devices)]
+
+def chosen_devices(value):
+    # the kits chosen in the device filter, or None when they all are; the value comes from the
+    # browser, so anything that is not a registered uid is dropped before it names a cached figure
+    registered = store.read_devices()['uid'].tolist()
+    if not isinstance(value, list):
+        return None
+    devices = [uid for uid in registered if uid in value]
+    if len(devices) == len(registered):
+        return None
+    return devices
+
+def select_readings(start=None, end=None, methods=None, devices=None, data=None):
+    # the readings between start and end, found by binary search rather than by scanning
+    if data is None:
+        data = get_combined_readings()
+    data = query.select_range(data, start, end)
+    if methods is not None:
+        data = data[data['Method'].isin(methods)]
+    return filter_devices(data, devices)
 
 def round_up_ten(x):
     if x == None or math.isnan(x) or x==0:
@@ -97,133 +162,123 @@ def round_up_ten(x):
         retval = int(math.ceil((x + 1) / 10)) * 10
     return retval
 
-def plot_readings(type, data):
-    log_message('plot_readings start' + ': ' + type)
-    xrange = [min(data["Timestamp"]) - dt.timedelta(days=1), max(data["Timestamp"]) + dt.timedelta(days=1)]
-    if type=="temperature":
-        p = px.scatter(
-            data,
-            x='Timestamp', y='Temperature',
-            range_x=xrange,
-            range_y=[-10,50],
-            color='Method',
-            color_discrete_map={
-                "Manual": "red",
-                "Enviro": "orange"},
-            symbol='Method',
-            symbol_map={
-                "Manual": "hexagram",
-                "Enviro": "cross"})
-    elif type=="humidity":
-        p = px.scatter(
-            data,
-            x='Timestamp', y='Humidity',
-            range_x=xrange,
-            range_y=[0,100], 
-            color='Method',
-            color_discrete_map={
-                "Manual": "blue",
-                "Enviro": "cyan"},
-            symbol='Method',
-            symbol_map={
-                "Manual": "hexagram",
-                "Enviro": "cross"})
-    elif type=="pressure":
-        p = px.scatter(
-            data[data['Method']=='Enviro'],
-            x='Timestamp', y='Pressure',
-            range_x=xrange,
-            range_y=[900, 1100],
-            color='Method',
-            color_discrete_map={
-                "Enviro": "green"},
-            symbol='Method',
-            symbol_map={
-                "Manual": "hexagram",
-                "Enviro": "cross"})
-    elif type=="noise":
-        p = px.scatter(
-            data[data['Method']=='Enviro'],
-            x='Timestamp', y='Noise',
-            range_x=xrange,
-            range_y=[0, round_up_ten(data.max()['Noise'])],
-            color='Method',
-            color_discrete_map={
-                "Enviro": "brown"},
-            symbol='Method',
-            symbol_map={
-                "Manual": "hexagram",
-                "Enviro": "cross"})
-    elif type=="aqi":
-        p = px.scatter(
-            data[data['Method']=='Manual'],
-            x='Timestamp', y='AQI',
-            range_x=xrange,
-            range_y=[0, round_up_ten(data.max()['AQI'])],
-            color='Method',
-            color_discrete_map={
-                "Manual": "orange"},
-            symbol='Method',
-            symbol_map={
-                "Manual": "hexagram",
-                "Enviro": "cross"})
-    elif type=="pm1":
-        p = px.scatter(
-            data[data['Method']=='Enviro'],
-            x='Timestamp', y='PM1',
-            range_x=xrange,
-            range_y=[0, round_up_ten(data.max()['PM1'])],
-            color='Method',
-            color_discrete_map={
-                "Enviro": "gray"},
-            symbol='Method',
-            symbol_map={
-                "Manual": "hexagram",
-                "Enviro": "cross"})
-    elif type=="pm25":
-        p = px.scatter(
-            data,
-            x='Timestamp', y='PM2.5',
-            range_x=xrange,
-            range_y=[0, round_up_ten(data.max()['PM2.5'])], 
-            color='Method',
-            color_discrete_map={
-                "Manual": "darkgray",
-                "Enviro": "gray"},
-            symbol='Method',
-            symbol_map={
-                "Manual": "hexagram",
-                "Enviro": "cross"})
-    elif type=="pm10":
-        p = px.scatter(
-            data,
-            x='Timestamp', y='PM10',
-            range_x=xrange,
-            range_y=[0, round_up_ten(data.max()['PM10'])], 
-            color='Method',
-            color_discrete_map={
-                "Manual": "darkslategray",
-                "Enviro": "darkgray"},
-            symbol='Method',
-            symbol_map={
-                "Manual": "hexagram",
-                "Enviro": "cross"})
-    elif type=="tvoc":
-        p = px.scatter(
-            data[data['Method']=='Manual'],
-            x='Timestamp', y='TVOC',
-            range_x=xrange,
-            range_y=[0, 5],
-            color='Method',
-            color_discrete_map={
-                "Manual": "black"},
-            symbol='Method',
-            symbol_map={
-                "Manual": "hexagram",
-                "Enviro": "cross"})
-    log_message('plot_readings end')
+# which readings each graph shows, and how
+plot_settings = {
+    'temperature': {'y': 'Temperature', 'range_y': [-10, 50],
+        'colors': {"Manual": "red", "Enviro": "orange"}},
+    'humidity': {'y': 'Humidity', 'range_y': [0, 100],
+        'colors': {"Manual": "blue", "Enviro": "cyan"}},
+    'pressure': {'y': 'Pressure', 'range_y': [900, 1100],
+        'colors': {"Enviro": "green"}},
+    # graphs without a fixed range_y go from zero to just above the highest reading
+    'noise': {'y': 'Noise', 'range_y': None,
+        'colors': {"Enviro": "brown"}},
+    'aqi': {'y': 'AQI', 'range_y': None,
+        'colors': {"Manual": "orange"}},
+    'pm1': {'y': 'PM1', 'range_y': None,
+        'colors': {"Enviro": "gray"}},
+    'pm25': {'y': 'PM2.5', 'range_y': None,
+        'colors': {"Manual": "darkgray", "Enviro": "gray"}},
+    'pm10': {'y': 'PM10', 'range_y': None,
+        'colors': {"Manual": "darkslategray", "Enviro": "darkgray"}},
+    'tvoc': {'y': 'TVOC', 'range_y': [0, 5],
+        'colors': {"Manual": "black"}},
+}
+
+# most points sent to the browser for one graph, however much history there is
+max_points_per_graph = 2000
+# graphs with more points than this are drawn with WebGL, which stays smooth where SVG does not
+webgl_threshold = 1000
+# how Enviro readings are drawn: 'markers', 'lines' or 'area'; dense readings read better as a line
+enviro_mode = 'markers'
+# seconds between checks for new readings while the graphs are showing
+live_interval = 15
+# rows on each page of the edit table
+edit_page_size = 20
+
+def plot_readings(type, data, xrange=None, range_y=None):
+    with metrics.span('plot_readings', graph=type):
+        return _plot_readings(type, data, xrange, range_y)
+
+def _plot_readings(type, data, xrange, range_y):
+    settings = plot_settings[type]
+    if xrange is None:
+        xrange = [data.index.min() - dt.timedelta(days=1), data.index.max() + dt.timedelta(days=1)]
+    if range_y is None:
+        range_y = settings['range_y']
+    if range_y is None:
+        range_y = [0, round_up_ten(data[settings['y']].max())]
+    data = data[data['Method'].isin(list(settings['colors']))]
+    data = downsample.downsample_readings(data, settings['y'], 'Method', max_points_per_graph)
+    # only the points being drawn are widened back for plotting
+    data = data.reset_index().astype({settings['y']: 'float64'}).round({settings['y']: 4})
+    if enviro_mode != 'markers':
+        data = break_gaps(data, settings['y'])
+    # one trace per Method in the order of its colors, even with no readings yet,
+    # so live updates know which trace to add each point to
+    missing = [m for m in settings['colors'] if not (data['Method'] == m).any()]
+    # plotly express is slow to import, and only drawing needs it
+    import plotly.express as px
+    data = pd.concat([data, pd.DataFrame({'Method': missing})], ignore_index=True)
+    p = px.scatter(
+        data,
+        x='Timestamp', y=settings['y'],
+        range_x=xrange,
+        range_y=range_y,
+        color='Method',
+        color_discrete_map=settings['colors'],
+        category_orders={'Method': list(settings['colors'])},
+        symbol='Method',
+        symbol_map={
+            "Manual": "hexagram",
+            "Enviro": "cross"},
+        render_mode='webgl' if len(data) > webgl_threshold else 'svg')
+    if enviro_mode != 'markers':
+        p.update_traces(selector={'name': 'Enviro'}, mode='lines',
+            **({'fill': 'tozeroy'} if enviro_mode == 'area' else {}))
     return p
 
+def break_gaps(data, y):
+    # an empty point before each gap in a kit's readings, so its line is not drawn across the gap
+    # or on to another kit's readings; a gap is much longer than the usual step between readings
+    enviro = data[data['Method'] == 'Enviro'].sort_values(['Device', 'Timestamp'], kind='mergesort')
+    step = enviro.groupby('Device', observed=True)['Timestamp'].diff()
+    # the lowest and highest readings of a rollup bucket share a time, so those steps are left out
+    gap = step.isna() | (step > 5 * step[step > pd.Timedelta(0)].median())
+    breaks = enviro[gap].assign(**{y: float('nan')})
+    enviro = pd.concat([breaks, enviro]).sort_values(['Device', 'Timestamp'], kind='mergesort')
+    # the traces stay in the order they were in
+    return pd.concat([enviro if method == 'Enviro' else data[data['Method'] == method]
+        for method in data['Method'].unique()] or [data], ignore_index=True)
+
+def figure_key(type, devices=None):
+    # figures for only some of the kits, or drawn in another mode, are cached under their own keys
+    key = type if enviro_mode == 'markers' else type + '-' + enviro_mode
+    return key if devices is None else key + '-' + '-'.join(sorted(devices))
+
+def draw_figure(type, devices=None, xrange=None, range_y=None):
+    # the figure keeps the live_position of its readings in its layout meta, so live updates
+    # can add just the readings that came after
+    if xrange is None:
+        data, position = get_cached_entry('graph', read_graph_readings)
+        data = filter_devices(data, devices)
+    else:
+        data, position = get_cached_entry('combined', read_combined_readings)
+        data = select_readings(xrange[0], xrange[1], list(plot_settings[type]['colors']), devices, data)
+    return plot_readings(type, data, xrange, range_y).update_layout(meta=position)
+
+def get_figure(type, devices=None):
+    # the full history figure, from the cache shared by all workers when possible
+    return figure_cache.get_figure(figure_key(type, devices), data_version(),
+        lambda: draw_figure(type, devices))
+
+def refresh_figures():
+    # draw the figures for new data now, so the next visitor does not wait for them
+    version = data_version()
+    for graph_type in plot_settings:
+        figure_cache.refresh(figure_key(graph_type), version,
+            lambda graph_type=graph_type: draw_figure(graph_type))
+
 
 app = dash.Dash(__name__)
 server = app.server
@@ -233,48 +288,190 @@ app.config.suppress_callback_exceptions = False
 
 api = Api(app.server)
 
+# the gists are a backup of the local store, updated from it in the background
+mirror.register('manual_readings', save_manual_readings)
+mirror.register('enviro_readings', save_enviro_readings)
+
+@server.before_request
+def start_mirror():
+    # started by the first request a process serves, so never in a gunicorn master
+    # that preloads the app, whose thread the forked workers would not have
+    mirror.start()
+
 class receive_data(Resource):
     def post(self):
-        response_code = 400
-        reqjson = json.loads(request.data.decode('utf-8'))
+        try:
+            reqjson = json.loads(request.data.decode('utf-8'))
+        except ValueError:
+            return {'message': 'invalid json'}, 400
         # make sure single readings are in a list
         if type(reqjson) == dict:
             allreadings = []
             allreadings.append(reqjson)
-        else:
+        elif type(reqjson) == list:
             allreadings = reqjson
-        # append new readings to existing ones
-        data = load_enviro_readings()
-        for line in allreadings:
-            if line['nickname'] == 'embsgarden':
-                new_row = pd.DataFrame({
-                    'timestamp': [line['timestamp']],
-                    'temperature': [line['readings']['temperature']],
-                    'humidity': [line['readings']['humidity']],
-                    'pressure': [line['readings']['pressure']],
-                    'noise': [line['readings']['noise']],
-                    'pm1': [line['readings']['pm1']],
-                    'pm2_5': [line['readings']['pm2_5']],
-                    'pm10': [line['readings']['pm10']]
-                    })
-                data = pd.concat([data, new_row])
-            else:
-                # ignore post
-                msg = 'invalid source'
-        if save_enviro_readings(data):
-            response_code = 200
-
-        return response_code
+        else:
+            return {'message': 'body must be a reading or a list of readings'}, 400
+        added = 0
+        with metrics.span('ingest'):
+            data, rejected = ingest.parse_enviro_readings(allreadings, store.read_devices())
+            # append new readings to the local store; readings it already holds are skipped,
+            # so a kit resending after a failed upload does no harm
+            if len(data) > 0:
+                store.ensure_seeded('enviro_readings', load_enviro_readings)
+                added = store.append_readings('enviro_readings', data)
+        metrics.count('readings_ingested_total', added, table='enviro_readings')
+        metrics.count('readings_skipped_total', len(data) - added, table='enviro_readings')
+        metrics.count('readings_rejected_total', len(rejected), table='enviro_readings')
+        if added > 0:
+            # the gist is updated in the background, so acknowledge straight away
+            mirror.request_flush()
+            refresh_figures()
+        response_code = 202
+        if len(rejected) > 0 and len(data) == 0:
+            response_code = 400
+
+        return {'accepted': added, 'skipped': len(data) - added, 'rejected': rejected}, response_code
 
 api.add_resource(receive_data, '/envirodata')
 
+# readings parsed from a bulk upload at a time, and the most one upload may hold
+bulk_chunk_rows = 5000
+bulk_max_rows = 500000
+# rejected readings described in the reply for each chunk; the rest are only counted
+bulk_error_examples = 5
+
+class receive_bulk_data(Resource):
+    def post(self):
+        # a backlog of readings as the csv a kit keeps (with uid or nickname in the query) or as
+        # ndjson, optionally gzipped; it is parsed a chunk at a time as it arrives, and stored as one batch
+        format = request.args.get('format', 'csv')
+        if format not in ingest.bulk_formats:
+            return {'message': 'format must be one of ' + ', '.join(ingest.bulk_formats)}, 400
+        body = request.stream
+        if request.headers.get('Content-Encoding', '').lower() == 'gzip':
+            body = gzip.GzipFile(fileobj=body, mode='rb')
+        devices = store.read_devices()
+        batches = []
+        chunks = []
+        rows = 0
+        with metrics.span('ingest_bulk', format=format):
+            try:
+                for items in ingest.read_chunks(body, format, bulk_chunk_rows):
+                    # a csv with a header and no readings gives an empty chunk
+                    if len(items) == 0:
+                        continue
+                    rows += len(items)
+                    if rows > bulk_max_rows:
+                        return {'message': 'at most ' + str(bulk_max_rows) + ' readings can be sent at once'}, 413
+                    data, rejected = ingest.parse_enviro_table(items, devices,
+                        request.args.get('uid'), request.args.get('nickname'))
+                    batches.append(data)
+                    chunks.append({'first': int(items.index[0]), 'rows': len(items), 'rejected': len(rejected),
+                        'errors': rejected[:bulk_error_examples]})
+            except ingest.InvalidBody:
+                return {'message': 'invalid ' + format + ' body'}, 400
+            valid = sum(len(data) for data in batches)
+            added = [0] * len(batches)
+            if valid > 0:
+                store.ensure_seeded('enviro_readings', load_enviro_readings)
+                added = store.append_batches('enviro_readings', batches)
+        for chunk, data, count in zip(chunks, batches, added):
+            chunk.update(accepted=count, skipped=len(data) - count)
+        metrics.count('readings_ingested_total', sum(added), table='enviro_readings')
+        metrics.count('readings_skipped_total', valid - sum(added), table='enviro_readings')
+        metrics.count('readings_rejected_total', rows - valid, table='enviro_readings')
+        if sum(added) > 0:
+            mirror.request_flush()
+            refresh_figures()
+        response_code = 202
+        if valid == 0:
+            response_code = 400
+        return {'accepted': sum(added), 'skipped': valid - sum(added), 'rejected': rows - valid,
+            'chunks': chunks}, response_code
+
+api.add_resource(receive_bulk_data, '/envirodata/bulk')
+
+class export_data(Resource):
+    def get(self):
+        format = request.args.get('format', 'csv')
+        if format not in export.formats:
+            return {'message': 'format must be one of ' + ', '.join(export.formats)}, 400
+        try:
+            start = store_time(request.args['from']) if 'from' in request.args else None
+            end = store_time(request.args['to']) if 'to' in request.args else None
+        except ValueError:
+            return {'message': 'invalid from or to'}, 400
+        method = request.args.get('method')
+        if method not in (None, 'Manual', 'Enviro'):
+            return {'message': 'method must be Manual or Enviro'}, 400
+        columns = None
+        if 'metric' in request.args:
+            columns = request.args['metric'].split(',')
+            if not set(columns) <= set(export.metric_names):
+                return {'message': 'metric must be from ' + ', '.join(export.metric_names)}, 400
+        # kits by uid, as in /api/readings; manual readings are always kept
+        devices = request.args['device'].split(',') if 'device' in request.args else None
+        compress = request.args.get('gzip', '').lower() in ('1', 'true', 'yes')
+        seed_store()
+        # the rows are read and sent a chunk at a time as the response is written
+        response = Response(export.stream_readings(format, compress, start, end, method, columns, devices),
+            mimetype=export.formats[format])
+        response.headers['Content-Disposition'] = 'attachment; filename=readings.' + format
+        if compress:
+            response.headers['Content-Encoding'] = 'gzip'
+        return response
+
+api.add_resource(export_data, '/export')
+
+class query_readings(Resource):
+    def get(self):
+        metric = request.args.get('metric')
+        if metric not in export.metric_names:
+            return {'message': 'metric must be one of ' + ', '.join(export.metric_names)}, 400
+        try:
+            start = pd.Timestamp(store_time(request.args['from'])) if 'from' in request.args else None
+            end = pd.Timestamp(store_time(request.args['to'])) if 'to' in request.args else None
+            bucket = request.args.get('bucket')
+            if bucket is not None:
+                pd.tseries.frequencies.to_offset(bucket)
+        except ValueError:
+            return {'message': 'invalid from, to or bucket'}, 400
+        method = request.args.get('method')
+        methods = [method] if method is not None else None
+        devices = request.args['device'].split(',') if 'device' in request.args else None
+        data = select_readings(start, end, methods, devices)
+        series = {m: query.columnar(data.loc[data['Method'] == m, metric], bucket)
+            for m in data['Method'].cat.categories}
+        series = {m: s for m, s in series.items() if s['value']}
+        if request.args.get('format') == 'arrow':
+            try:
+                body = query.to_arrow(series)
+            except ImportError:
+                return {'message': 'arrow output needs pyarrow to be installed'}, 400
+            return Response(body, mimetype='application/vnd.apache.arrow.stream')
+        return {'metric': metric, 'bucket': bucket, 'series': series}
+
+api.add_resource(query_readings, '/api/readings')
+
+class serve_metrics(Resource):
+    def get(self):
+        if not metrics.enabled:
+            return {'message': 'metrics are not enabled'}, 404
+        return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+api.add_resource(serve_metrics, '/metrics')
+
 def serve_layout():
-    manual_readings = load_manual_readings()
-    enviro_readings = load_enviro_readings()
-    combined_readings = combine_readings(manual_readings, enviro_readings)
+    devices = store.read_devices()
     return html.Div(
     [
-        dcc.Location(id='url'),
+        # the graphs showing are checked for new readings every live_interval seconds, and
+        # drawn again when readings are edited
+        dcc.Interval(id='live-interval', interval=live_interval * 1000),
+        dcc.Store(id='live-sent'),
+        dcc.Store(id='live-redraw'),
+        dcc.Store(id='saved-version'),
         html.Div(
             [
                 html.Span(children=[
@@ -315,69 +512,31 @@ def serve_layout():
                             label='GRAPHS',
                             value='view-graphs',
                             children=[
+                                # only shown once there is more than one kit to choose between
                                 html.Div(
                                     [
-                                        dcc.Graph(id='plot-temperature',
-                                        figure=plot_readings("temperature", combined_readings))
-                                    ],
-                                    className='graph__container',
-                                ),
-                                html.Div(
-                                    [
-                                        dcc.Graph(id='plot-humidity',
-                                        figure=plot_readings("humidity", combined_readings))
-                                    ],
-                                    className='graph__container',
-                                ),
-                                html.Div(
-                                    [
-                                        dcc.Graph(id='plot-pressure',
-                                        figure=plot_readings("pressure", combined_readings))
-                                    ],
-                                    className='graph__container',
-                                ),
-                                html.Div(
-                                    [
-                                        dcc.Graph(id='plot-noise',
-                                        figure=plot_readings("noise", combined_readings))
-                                    ],
-                                    className='graph__container',
-                                ),
-                                html.Div(
-                                    [
-                                        dcc.Graph(id='plot-aqi',
-                                        figure=plot_readings("aqi", combined_readings))
-                                    ],
-                                    className='graph__container',
-                                ),
-                                html.Div(
-                                    [
-                                        dcc.Graph(id='plot-pm1',
-                                        figure=plot_readings("pm1", combined_readings))
-                                    ],
-                                    className='graph__container',
-                                ),
-                                html.Div(
-                                    [
-                                        dcc.Graph(id='plot-pm25',
-                                        figure=plot_readings("pm25", combined_readings))
-                                    ],
-                                    className='graph__container',
-                                ),
-                                html.Div(
-                                    [
-                                        dcc.Graph(id='plot-pm10',
-                                        figure=plot_readings("pm10", combined_readings))
+                                        dcc.Dropdown(
+                                            id='device-filter',
+                                            options=[{'label': device.nickname, 'value': device.uid}
+                                                for device in devices.itertuples()],
+                                            value=list(devices['uid']),
+                                            multi=True,
+                                            placeholder='Choose Enviro kits'
+                                        )
                                     ],
-                                    className='graph__container',
-                                ),
+                                    className='dropdown__container',
+                                    hidden=len(devices) < 2
+                                )
+                            ] + [
+                                # the figures are filled in by update_graph once this tab is showing
                                 html.Div(
                                     [
-                                        dcc.Graph(id='plot-tvoc',
-                                        figure=plot_readings("tvoc", combined_readings))
+                                        dcc.Graph(id='plot-' + graph_type),
+                                        dcc.Store(id='drawn-' + graph_type)
                                     ],
                                     className='graph__container',
-                                ),
+                                )
+                                for graph_type in plot_settings
                             ],
                         ),
                         dcc.Tab(
@@ -478,14 +637,24 @@ def serve_layout():
                                 html.Div(
                                     [
                                         html.Div([
+                                            # filled a page at a time by update_edit_table
                                             dash_table.DataTable(
                                                 id='edit-table',
-                                                data=manual_readings.to_dict('records'),
-                                                columns=[{'name': i, 'id': i} for i in manual_readings.columns],
+                                                columns=[{'name': i, 'id': i, 'type': 'text' if i == 'Timestamp' else 'numeric'}
+                                                    for i in store.tables['manual_readings']],
                                                 editable=True,
-                                                row_deletable=True
+                                                row_deletable=True,
+                                                page_action='custom',
+                                                page_current=0,
+                                                page_size=edit_page_size,
+                                                sort_action='custom',
+                                                sort_by=[],
+                                                filter_action='custom',
+                                                filter_query=''
                                             )
                                         ]),
+                                        # the rows edited or deleted since the last save, on any page
+                                        dcc.Store(id='edit-changes'),
                                         html.Div(id='edit-table-dummy', hidden=True),
                                         html.Div(
                                             [
@@ -626,7 +795,8 @@ app.layout = serve_layout
 
 
 @app.callback(
-    Output('url', 'href'),
+    Output('saved-version', 'data'),
+    Output('tabs', 'value'),
     Input('save-reading', 'n_clicks'),
     Input('save-table', 'n_clicks'),
     [
@@ -638,11 +808,11 @@ app.layout = serve_layout
         State('input-pm25', 'value'),
         State('input-pm10', 'value'),
         State('input-tvoc', 'value'),
-        State('edit-table', 'data')
+        State('edit-changes', 'data')
     ],
     prevent_initial_call=True
 )
-def save_changes(submit_reading_clicks, save_table_clicks, input_date, input_time, input_temperature, input_humidity, input_aqi, input_pm25, input_pm10, input_tvoc, table_data):
+def save_changes(submit_reading_clicks, save_table_clicks, input_date, input_time, input_temperature, input_humidity, input_aqi, input_pm25, input_pm10, input_tvoc, changes):
     triggered_id = ctx.triggered_id
     if triggered_id == 'save-reading':
         new_row = pd.DataFrame({
@@ -656,10 +826,108 @@ def save_changes(submit_reading_clicks, save_table_clicks, input_date, input_tim
                 'TVOC': [input_tvoc]
                 }
             )
-        save_manual_readings(pd.concat([load_manual_readings(), new_row]))
+        store.ensure_seeded('manual_readings', load_manual_readings)
+        store.append_readings('manual_readings', new_row)
+        metrics.count('readings_ingested_total', 1, table='manual_readings')
     elif triggered_id == 'save-table':
-        save_manual_readings(pd.DataFrame(table_data))
-    return '/'
+        if changes is None or not (changes['changed'] or changes['deleted']):
+            raise PreventUpdate
+        changed = pd.DataFrame(list(changes['changed'].values()),
+            columns=['id'] + store.tables['manual_readings']).rename(columns={'id': 'rowid'})
+        store.edit_readings('manual_readings', changed, changes['deleted'])
+    mirror.request_flush()
+    refresh_figures()
+    # back to the graphs, which the live update brings up to date, rather than reloading the page
+    return data_version(), 'view-graphs'
+
+
+# the edit table's filter operators, as read_page takes them; the table writes the operator
+# as typed, so both the symbols and the words it uses for them are read
+filter_operators = {'=': '=', '!=': '!=', '<': '<', '<=': '<=', '>': '>', '>=': '>=',
+    'eq': '=', 'ne': '!=', 'lt': '<', 'le': '<=', 'gt': '>', 'ge': '>=',
+    'contains': 'contains', 'datestartswith': 'startswith'}
+
+def parse_filter(filter_query):
+    # the (column, operator, value) filters in the edit table's filter_query, such as
+    # {Temperature} > 20 && {Humidity} ge 50 && {Timestamp} contains 2023; parts that cannot
+    # be read are ignored
+    filters = []
+    for part in (filter_query or '').split(' && '):
+        if '{' not in part or '}' not in part:
+            continue
+        column = part[part.find('{') + 1:part.rfind('}')]
+        rest = part[part.rfind('}') + 1:].strip()
+        # the table may prefix an operator with s or i for case sensitivity, as in s> or icontains;
+        # the columns hold numbers and timestamps, so the prefix is dropped
+        if rest[:1] in ('s', 'i') and any(rest[1:].startswith(o) for o in filter_operators):
+            rest = rest[1:]
+        # the longest operator the rest starts with, so <= is not read as <; a word needs a space after it
+        found = [o for o in filter_operators
+            if rest.startswith(o) and (not o.isalpha() or rest[len(o):][:1] == ' ')]
+        if column not in store.tables['manual_readings'] or not found:
+            continue
+        operator = max(found, key=len)
+        value = rest[len(operator):].strip()
+        operator = filter_operators[operator]
+        if not value:
+            continue
+        if value[0] == value[-1] and value[0] in ('"', "'", '`') and len(value) > 1:
+            value = value[1:-1].replace('\\' + value[0], value[0])
+        elif column != 'Timestamp' and operator not in ('contains', 'startswith'):
+            try:
+                value = float(value)
+            except ValueError:
+                pass
+        filters.append((column, operator, value))
+    return filters
+
+@app.callback(
+    Output('edit-table', 'data'),
+    Output('edit-table', 'page_count'),
+    Input('tabs', 'value'),
+    Input('edit-table', 'page_current'),
+    Input('edit-table', 'page_size'),
+    Input('edit-table', 'sort_by'),
+    Input('edit-table', 'filter_query'),
+    Input('saved-version', 'data'),
+    State('edit-changes', 'data')
+)
+def update_edit_table(tab, page_current, page_size, sort_by, filter_query, saved_version, changes):
+    # only the page showing is read and sent, with unsaved changes to it kept
+    if tab != 'manual-readings-table':
+        raise PreventUpdate
+    store.ensure_seeded('manual_readings', load_manual_readings)
+    data, total = store.read_page('manual_readings', page_current * page_size, page_size,
+        [(sort['column_id'], sort['direction'] == 'asc') for sort in sort_by or []], parse_filter(filter_query))
+    rows = data.rename(columns={'rowid': 'id'}).to_dict('records')
+    if changes is not None:
+        rows = [changes['changed'].get(str(row['id']), row) for row in rows if row['id'] not in changes['deleted']]
+    return rows, max(1, math.ceil(total / page_size))
+
+@app.callback(
+    Output('edit-changes', 'data'),
+    Input('edit-table', 'data_timestamp'),
+    Input('saved-version', 'data'),
+    State('edit-table', 'data'),
+    State('edit-table', 'data_previous'),
+    State('edit-changes', 'data'),
+    prevent_initial_call=True
+)
+def track_edits(data_timestamp, saved_version, data, data_previous, changes):
+    # rows are known by their id, the rowid in the store, so only they are sent when saving
+    if ctx.triggered_id == 'saved-version':
+        return {'changed': {}, 'deleted': []}
+    if data_previous is None:
+        raise PreventUpdate
+    changes = changes or {'changed': {}, 'deleted': []}
+    current = {row['id']: row for row in data}
+    for row in data_previous:
+        if row['id'] not in current:
+            changes['changed'].pop(str(row['id']), None)
+            changes['deleted'].append(row['id'])
+        elif current[row['id']] != row:
+            changes['changed'][str(row['id'])] = current[row['id']]
+    return changes
 
 
 @app.callback(
@@ -697,5 +965,169 @@ def test_enviro(save_enviro_clicks):
     return result.status_code
 
 
+def drawn(figure, zoomed=False):
+    # the outputs of update_graph: the figure, its class, and what it was drawn with: the
+    # live_position of its readings and, unless zoomed in, the end of its x axis and top of its y axis
+    figure = figure if isinstance(figure, dict) else figure.to_dict()
+    layout = figure['layout']
+    limits = {'position': layout.get('meta')}
+    if not zoomed:
+        limits['x_end'] = store_time(layout['xaxis']['range'][1])
+        limits['y_max'] = layout['yaxis']['range'][1]
+    return figure, 'graph--drawn', limits
+
+def graph_callback(type):
+    def update_graph(tab, device_value, redraw, relayout_data, class_name):
+        if tab != 'view-graphs':
+            raise PreventUpdate
+        devices = chosen_devices(device_value)
+        zoomed = relayout_data is not None and 'xaxis.range[0]' in relayout_data
+        if ctx.triggered_id in ('device-filter', 'live-redraw') and not zoomed:
+            return drawn(get_figure(type, devices))
+        if ctx.triggered_id == 'tabs' or relayout_data is None:
+            # draw the full history the first time the graph is shown
+            if class_name == 'graph--drawn':
+                raise PreventUpdate
+            return drawn(get_figure(type, devices))
+        # redraw the visible range from the store, so zooming in reveals the full detail
+        if zoomed:
+            xrange = [pd.Timestamp(relayout_data['xaxis.range[0]'], tz='UTC'),
+                pd.Timestamp(relayout_data['xaxis.range[1]'], tz='UTC')]
+            range_y = None
+            if 'yaxis.range[0]' in relayout_data:
+                range_y = [relayout_data['yaxis.range[0]'], relayout_data['yaxis.range[1]']]
+            return drawn(draw_figure(type, devices, xrange, range_y), zoomed=True)
+        elif 'xaxis.autorange' in relayout_data:
+            return drawn(get_figure(type, devices))
+        raise PreventUpdate
+    return update_graph
+
+# one callback per graph, so the browser requests them in parallel and any worker can draw each one
+for graph_type in plot_settings:
+    app.callback(
+        Output('plot-' + graph_type, 'figure'),
+        Output('plot-' + graph_type, 'className'),
+        Output('drawn-' + graph_type, 'data'),
+        Input('tabs', 'value'),
+        Input('device-filter', 'value'),
+        Input('live-redraw', 'data'),
+        Input('plot-' + graph_type, 'relayoutData'),
+        State('plot-' + graph_type, 'className'),
+    )(graph_callback(graph_type))
+
+def read_new_readings(start, devices):
+    # the readings added after start, a live_position, and the live_position they go up to
+    with store.reading():
+        end = live_position()
+        manual = store.read_since('manual_readings', start['manual_readings'][1])
+        enviro = store.read_since('enviro_readings', start['enviro_readings'][1], devices)
+    return query.combine_readings(manual, enviro), end
+
+def extend_figure(type, data):
+    # extendData adding the readings to a figure from plot_readings, which has a trace for
+    # each Method in the order of its colors
+    settings = plot_settings[type]
+    update = {'x': [], 'y': []}
+    traces = []
+    for i, method in enumerate(settings['colors']):
+        values = data.loc[data['Method'] == method, settings['y']].dropna().astype('float64').round(4)
+        if len(values) > 0:
+            update['x'].append(values.index.strftime('%Y-%m-%dT%H:%M:%S+00:00').tolist())
+            update['y'].append(values.tolist())
+            traces.append(i)
+    if not traces:
+        return dash.no_update
+    return [update, traces]
+
+def fits_axes(type, data, limits):
+    # whether the readings fall within the axes the graph was drawn with, which extendData cannot
+    # widen; a graph zoomed in shows the range chosen, and a fixed range_y is kept whatever the readings
+    settings = plot_settings[type]
+    values = data.loc[data['Method'].isin(list(settings['colors'])), settings['y']].dropna()
+    if len(values) == 0 or 'x_end' not in limits:
+        return True
+    if values.index.max() > pd.Timestamp(limits['x_end']):
+        return False
+    return settings['range_y'] is not None or values.max() <= limits['y_max']
+
+@app.callback(
+    [Output('plot-' + graph_type, 'extendData') for graph_type in plot_settings]
+        + [Output('live-sent', 'data'), Output('live-redraw', 'data')],
+    [Input('live-interval', 'n_intervals'), Input('saved-version', 'data')],
+    [State('live-sent', 'data'), State('tabs', 'value'), State('device-filter', 'value')]
+        + [State('drawn-' + graph_type, 'data') for graph_type in plot_settings],
+    prevent_initial_call=True
+)
+def live_update(n_intervals, saved_version, sent, tab, device_value, *drawn_limits):
+    # adds readings that arrived since each graph was drawn, or last added to, to the graphs;
+    # if readings were edited or removed instead, more have been added since a graph was drawn
+    # than a graph is drawn with, or they fall outside its axes, the graphs are drawn again
+    if tab != 'view-graphs':
+        raise PreventUpdate
+    devices = chosen_devices(device_value)
+    sent = sent or {}
+    # what each graph was drawn with, for the graphs drawn so far
+    limits = {graph_type: limit for graph_type, limit in zip(plot_settings, drawn_limits) if limit is not None}
+    positions = {graph_type: limit['position'] for graph_type, limit in limits.items()}
+    starts = {}
+    # the readings added to each graph since it was drawn
+    added = {}
+    for graph_type, position in positions.items():
+        last = sent.get(graph_type)
+        if last is not None and last['drawn'] == position:
+            starts[graph_type], added[graph_type] = last['end'], last.get('points', 0)
+        else:
+            starts[graph_type], added[graph_type] = position, 0
+    no_updates = [dash.no_update] * len(plot_settings)
+    if any(start[name][0] < store.rewritten(name) for start in starts.values() for name in start):
+        return no_updates + [{}, dt.datetime.now().timestamp()]
+    extend = dict(zip(plot_settings, no_updates))
+    new_sent = {}
+    # graphs drawn at the same time share their new readings
+    for key in set(json.dumps(start, sort_keys=True) for start in starts.values()):
+        data, end = read_new_readings(json.loads(key), devices)
+        for graph_type, start in starts.items():
+            if json.dumps(start, sort_keys=True) == key:
+                # a page left open would otherwise grow its graphs without limit
+                if added[graph_type] + len(data) > max_points_per_graph \
+                        or not fits_axes(graph_type, data, limits[graph_type]):
+                    return no_updates + [{}, dt.datetime.now().timestamp()]
+                extend[graph_type] = extend_figure(graph_type, data)
+                new_sent[graph_type] = {'drawn': positions[graph_type], 'end': end,
+                    'points': added[graph_type] + len(data)}
+    if new_sent == sent and all(e is dash.no_update for e in extend.values()):
+        raise PreventUpdate
+    return list(extend.values()) + [new_sent, dash.no_update]
+
+def warm_up():
+    # fill the store from the gists, and the readings and figure caches, before the first visitor;
+    # under gunicorn --preload this runs once in the master, and the workers share the result.
+    # If the gists cannot be read, the app starts anyway and requests seed the store as before;
+    # returns whether it warmed up
+    warmed = True
+    try:
+        seed_store()
+        version = data_version()
+        get_cached_entry('combined', read_combined_readings)
+        for graph_type in plot_settings:
+            figure_cache.warm(figure_key(graph_type), version, lambda graph_type=graph_type: draw_figure(graph_type))
+    except Exception as e:
+        warmed = False
+        metrics.count('warm_up_failures_total')
+        print('embs: warm up failed, starting without it: ' + repr(e), file=sys.stderr)
+    # leave what is loaded now out of garbage collection, which would otherwise write to, and so
+    # copy, the memory each worker shares with the master
+    gc.freeze()
+    return warmed
+
+def report_startup(phase):
+    seconds = time.perf_counter() - import_started
+    metrics.gauge('startup_seconds', seconds, phase=phase)
+    print('embs: ' + phase + ' after ' + str(round(seconds, 2)) + 's', file=sys.stderr)
+
+report_startup('imported')
+if 'gunicorn' in sys.modules and warm_up():
+    report_startup('warmed up')
+
 if __name__ == '__main__':
     app.run_server(debug=True)
\ No newline at end of file
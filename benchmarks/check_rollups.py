@@ -0,0 +1,54 @@
+# Checks that editing a reading recomputes only the rollup buckets it falls in: every other hour
+# of its day keeps its counts, and every bucket matches one built from scratch.
+# Runs against a scratch store. Run from the repository root: python benchmarks/check_rollups.py
+import os
+import sys
+import tempfile
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+import synthetic
+import store
+
+name = 'enviro_readings'
+
+def rollups():
+    return {period: store.read_rollups(name, period).set_index(['device', 'metric', 'bucket']).sort_index().round(6)
+        for period in store.rollup_periods}
+
+def rebuilt():
+    # the rollups as they would be built from every row, leaving the store's own as they were
+    con = store.connect()
+    con.execute('BEGIN')
+    try:
+        store._rebuild_rollups(con, name, store._read_all(con, name))
+        return rollups()
+    finally:
+        con.execute('ROLLBACK')
+
+def check():
+    store.db_path = os.path.join(tempfile.mkdtemp(prefix='embs-check-'), 'embs.db')
+    # two days of readings, four to each hour
+    store.append_readings(name, synthetic.enviro_readings(2).drop(columns=['voltage']))
+    timestamp = '2023-01-01T10:15:00Z'
+    before = rollups()
+    row = store.read_readings(name, timestamp, timestamp)
+    rowid = store.connect().execute('SELECT rowid FROM ' + name + ' WHERE timestamp = ?', (timestamp,)).fetchone()[0]
+    store.edit_readings(name, row.assign(rowid=rowid, temperature=row['temperature'] + 10), [])
+    after = rollups()
+    problems = []
+    hours = before['hour'].index.get_level_values('bucket')
+    untouched = before['hour'][hours != '2023-01-01T10:00:00Z']
+    if not untouched.equals(after['hour'].loc[untouched.index]):
+        problems.append('other hours changed')
+    expected = rebuilt()
+    for period in store.rollup_periods:
+        if not after[period].equals(expected[period]):
+            problems.append(period + ' buckets do not match a rebuild')
+    return problems
+
+if __name__ == '__main__':
+    problems = check()
+    if problems:
+        sys.exit('rollups: ' + '; '.join(problems))
+    print('rollups: ok')
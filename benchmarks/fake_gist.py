@@ -0,0 +1,142 @@
+import json
+import time
+import hashlib
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# GitHub stops sending inline content past this size and sets truncated instead
+truncate_at = 1024 * 1024
+
+class FakeGist:
+    # a local stand-in for the parts of the GitHub gist API the app uses
+    def __init__(self, delay=0.0, rate_limit=5000):
+        self.delay = delay
+        self.rate_limit = rate_limit
+        self.gists = {}
+        # each gist's revisions, newest first, as (version, files)
+        self.revisions = {}
+        # file contents by sha, so raw urls from old revisions still resolve
+        self.blobs = {}
+        self.log = []
+        self.lock = threading.Lock()
+        self.server = None
+        self.url = None
+
+    def create(self, gist_id, files):
+        with self.lock:
+            self.gists[gist_id] = dict(files)
+            self.revisions[gist_id] = []
+            self._new_revision(gist_id)
+
+    def files(self, gist_id):
+        with self.lock:
+            return dict(self.gists[gist_id])
+
+    def _new_revision(self, gist_id):
+        files = dict(self.gists[gist_id])
+        # a version for every commit, even one with the same files as an earlier one
+        version = hashlib.sha1((json.dumps(files, sort_keys=True)
+            + str(len(self.revisions[gist_id]))).encode('utf-8')).hexdigest()
+        self.revisions[gist_id].insert(0, (version, files))
+
+    def _body(self, gist_id, version=None):
+        current, files = self.revisions[gist_id][0]
+        if version is not None:
+            files = dict(self.revisions[gist_id]).get(version)
+            if files is None:
+                return None
+        body = {}
+        for name, content in files.items():
+            sha = hashlib.sha1(content.encode('utf-8')).hexdigest()
+            self.blobs[sha] = content
+            body[name] = {
+                'filename': name,
+                'raw_url': self.url + '/raw/' + gist_id + '/' + sha + '/' + name,
+                'size': len(content),
+                'truncated': len(content) > truncate_at,
+                'content': content[:truncate_at]
+            }
+        return {'id': gist_id, 'files': body,
+            'history': [{'version': v} for v, _ in self.revisions[gist_id]]}
+
+    def start(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def _reply(self, status, body=b'', headers=None):
+                self.send_response(status)
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return len(body)
+
+            def _handle(self, method):
+                time.sleep(fake.delay)
+                length = int(self.headers.get('Content-Length', 0))
+                request_body = self.rfile.read(length) if length else b''
+                parts = self.path.strip('/').split('/')
+                status, body, headers = fake._route(method, parts, request_body, self.headers)
+                sent = self._reply(status, body, headers)
+                with fake.lock:
+                    fake.log.append({'method': method, 'path': self.path, 'status': status,
+                        'bytes_in': len(request_body), 'bytes_out': sent, 'time': time.time()})
+
+            def do_GET(self):
+                self._handle('GET')
+
+            def do_PATCH(self):
+                self._handle('PATCH')
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:' + str(self.server.server_address[1])
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.url
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _route(self, method, parts, request_body, request_headers):
+        with self.lock:
+            if parts[0] == 'raw' and len(parts) == 4 and method == 'GET':
+                content = self.blobs.get(parts[2])
+                if content is None:
+                    return 404, b'', {}
+                return 200, content.encode('utf-8'), {'Content-Type': 'text/plain'}
+            not_found = 404, b'{"message": "Not Found"}', {'Content-Type': 'application/json'}
+            if parts[0] != 'gists' or len(parts) not in (2, 3) or parts[1] not in self.gists:
+                return not_found
+            gist_id = parts[1]
+            if len(parts) == 3:
+                # the gist at an earlier revision
+                body = self._body(gist_id, parts[2]) if method == 'GET' else None
+                if body is None:
+                    return not_found
+                return 200, json.dumps(body).encode('utf-8'), {'Content-Type': 'application/json'}
+            if method == 'PATCH':
+                before = dict(self.gists[gist_id])
+                for name, file in json.loads(request_body)['files'].items():
+                    if file is None:
+                        self.gists[gist_id].pop(name, None)
+                    else:
+                        self.gists[gist_id][name] = file['content']
+                # as on GitHub, a PATCH that changes nothing makes no new revision
+                if self.gists[gist_id] != before:
+                    self._new_revision(gist_id)
+            etag = 'W/"' + self.revisions[gist_id][0][0] + '"'
+            if method == 'GET' and request_headers.get('If-None-Match') == etag:
+                # conditional requests that match do not count against the rate limit
+                return 304, b'', {'ETag': etag}
+            self.rate_limit = max(self.rate_limit - 1, 0)
+            headers = {'Content-Type': 'application/json', 'ETag': etag,
+                'X-RateLimit-Remaining': str(self.rate_limit),
+                'X-RateLimit-Reset': str(int(time.time()) + 3600)}
+            return 200, json.dumps(self._body(gist_id)).encode('utf-8'), headers
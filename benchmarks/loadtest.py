@@ -0,0 +1,342 @@
+# Load test: many Enviro kits uploading their readings, dashboard viewers loading and watching
+# the graphs, and readings submitted by hand, all at once against the app served by gunicorn,
+# with the gists on a local fake server. Reports the throughput, latency percentiles and errors
+# of each kind of request, and any acknowledged readings missing from the store or, once the
+# mirror has caught up, from the gists. Every combination of workers and kits runs in a fresh
+# process against a fresh store, so the results can be used to size the number of workers.
+# Run from the repository root: python benchmarks/loadtest.py [--kits 10 50] [--output results.json] [workers ...]
+import io
+import os
+import sys
+import json
+import math
+import time
+import types
+import random
+import socket
+import argparse
+import tempfile
+import itertools
+import threading
+import subprocess
+import collections
+import numpy as np
+import pandas as pd
+import requests
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+import offline
+import synthetic
+import run
+
+default_workers = [1, 2, 4]
+# the part of the app a viewer's browser calls back to
+callback_url = '/_dash-update-component'
+
+def serve():
+    # the gunicorn app factory, run in the server process started by run_load
+    fake = types.SimpleNamespace(url=os.environ['EMBS_LOADTEST_GIST_URL'])
+    offline.configure(fake, os.environ['EMBS_LOADTEST_WORKDIR'],
+        float(os.environ['EMBS_LOADTEST_FLUSH_INTERVAL']))
+    return offline.import_app().server
+
+def kit_device(index):
+    # the uid and nickname of each simulated kit
+    return 'feed{:012x}'.format(index), 'loadkit' + str(index)
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def start_server(args, fake, workdir):
+    port = free_port()
+    env = dict(os.environ, EMBS_LOADTEST_GIST_URL=fake.url, EMBS_LOADTEST_WORKDIR=workdir,
+        EMBS_LOADTEST_FLUSH_INTERVAL=str(args.flush_interval))
+    log = open(os.path.join(workdir, 'gunicorn.log'), 'w')
+    # as in the Procfile, with the app loaded and warmed up once in the master
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', 'loadtest:serve()',
+        '--pythonpath', os.path.dirname(os.path.abspath(__file__)), '--workers', str(args.workers),
+        '--bind', '127.0.0.1:' + str(port), '--timeout', str(args.request_timeout), '--preload'],
+        env=env, stdout=log, stderr=subprocess.STDOUT)
+    url = 'http://127.0.0.1:' + str(port)
+    deadline = time.time() + args.startup_timeout
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError('gunicorn exited; see ' + log.name)
+        try:
+            if requests.get(url + '/_dash-layout', timeout=args.request_timeout).ok:
+                return server, url
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.5)
+    server.terminate()
+    raise RuntimeError('gunicorn did not start within ' + str(args.startup_timeout) + 's')
+
+def timed(records, kind, call):
+    # a failed request is recorded by its status, or by the exception if there was no response
+    start = time.perf_counter()
+    try:
+        response = call()
+        outcome = response.status_code
+    except requests.RequestException as e:
+        response = None
+        outcome = type(e).__name__
+    records.append({'kind': kind, 'latency': time.perf_counter() - start,
+        'ok': response is not None and response.status_code < 400, 'outcome': outcome})
+    return response
+
+def callback_request(outputs, inputs, state, changed):
+    # the body dash's renderer posts for a callback; outputs, inputs and state are (id, property, value)
+    return {
+        'output': '..' + '...'.join(i + '.' + p for i, p in outputs) + '..',
+        'outputs': [{'id': i, 'property': p} for i, p in outputs],
+        'inputs': [{'id': i, 'property': p, 'value': v} for i, p, v in inputs],
+        'state': [{'id': i, 'property': p, 'value': v} for i, p, v in state],
+        'changedPropIds': changed,
+    }
+
+def live_request(graph_types, n_intervals, sent, positions):
+    return callback_request(
+        [('plot-' + t, 'extendData') for t in graph_types] + [('live-sent', 'data'), ('live-redraw', 'data')],
+        [('live-interval', 'n_intervals', n_intervals), ('saved-version', 'data', None)],
+        [('live-sent', 'data', sent), ('tabs', 'value', 'view-graphs'), ('device-filter', 'value', None)]
+            + [('drawn-' + t, 'data', positions.get(t)) for t in graph_types],
+        ['live-interval.n_intervals'])
+
+def submit_request(timestamp, values):
+    return callback_request([('saved-version', 'data'), ('tabs', 'value')],
+        [('save-reading', 'n_clicks', 1), ('save-table', 'n_clicks', None)],
+        [('input-date', 'date', timestamp.strftime('%Y-%m-%d')), ('input-time', 'value', timestamp.strftime('%H:%M:%S'))]
+            + [('input-' + c, 'value', v) for c, v in values.items()] + [('edit-changes', 'data', None)],
+        ['save-reading.n_clicks'])
+
+def graph_types(url):
+    # the graphs the live update extends, in the order its callback lists them
+    for dependency in requests.get(url + '/_dash-dependencies').json():
+        if '.live-sent.data.' in dependency['output']:
+            return [o[len('plot-'):-len('.extendData')] for o in dependency['output'].strip('.').split('...')
+                if o.endswith('.extendData')]
+    raise RuntimeError('no live update callback')
+
+def kit(url, index, start, deadline, args, records, sent):
+    # uploads a batch of readings every kit_interval seconds, as upload_on_poke does, each batch
+    # following on from the last; readings are recorded as sent once the app acknowledges them
+    uid, nickname = kit_device(index)
+    session = requests.Session()
+    spacing = pd.Timedelta(minutes=15 * args.batch)
+    # kits are not in step with each other
+    time.sleep(random.uniform(0, args.kit_interval))
+    for batch in itertools.count():
+        if time.time() >= deadline:
+            return
+        readings = synthetic.enviro_readings(math.ceil(args.batch / 96), start=start + spacing * batch,
+            seed=index).head(args.batch)
+        body = json.dumps(synthetic.enviro_payload(readings, nickname, uid))
+        response = timed(records, 'kit_upload',
+            lambda: session.post(url + '/envirodata', data=body, timeout=args.request_timeout))
+        if response is not None and response.status_code == 202:
+            sent.extend((uid, t) for t in readings['timestamp'])
+        time.sleep(args.kit_interval)
+
+def viewer(url, graphs, deadline, args, records):
+    # loads the page and draws every graph, watches it for polls live updates, then loads it again
+    session = requests.Session()
+    time.sleep(random.uniform(0, args.view_interval))
+    n_intervals = itertools.count(1)
+    while time.time() < deadline:
+        timed(records, 'serve_layout', lambda: session.get(url + '/_dash-layout', timeout=args.request_timeout))
+        positions = {}
+        sent = None
+        for polls in itertools.count():
+            for graph_type in graphs:
+                if graph_type in positions:
+                    continue
+                response = timed(records, 'graph', lambda: session.post(url + callback_url,
+                    json=run.graph_request(graph_type), timeout=args.request_timeout))
+                if response is not None and response.status_code == 200:
+                    positions[graph_type] = response.json()['response']['drawn-' + graph_type]['data']
+            if polls == args.polls or time.time() >= deadline:
+                break
+            time.sleep(args.live_interval)
+            response = timed(records, 'live_update', lambda: session.post(url + callback_url,
+                json=live_request(graphs, next(n_intervals), sent, positions), timeout=args.request_timeout))
+            if response is not None and response.status_code == 200:
+                outputs = response.json()['response']
+                sent = outputs.get('live-sent', {}).get('data', sent)
+                if 'live-redraw' in outputs:
+                    # readings were edited, so the browser draws every graph again
+                    positions = {}
+                    sent = None
+        time.sleep(args.view_interval)
+
+def submitter(url, index, start, deadline, args, records, sent):
+    # each submitter's readings are a minute apart, at seconds of their own, so none share a timestamp
+    session = requests.Session()
+    rng = np.random.default_rng(index)
+    time.sleep(random.uniform(0, args.submit_interval))
+    for n in itertools.count():
+        if time.time() >= deadline:
+            return
+        timestamp = start + pd.Timedelta(minutes=n, seconds=index)
+        values = {'temperature': round(rng.normal(12, 4), 1), 'humidity': round(rng.normal(60, 10), 1),
+            'aqi': int(rng.integers(0, 5)), 'pm25': int(rng.integers(0, 40)), 'pm10': int(rng.integers(0, 60)),
+            'tvoc': round(rng.uniform(0, 1), 3)}
+        response = timed(records, 'manual_submit', lambda: session.post(url + callback_url,
+            json=submit_request(timestamp, values), timeout=args.request_timeout))
+        if response is not None and response.status_code == 200:
+            sent.append(timestamp.strftime('%Y-%m-%dT%H:%M:%SZ'))
+        time.sleep(args.submit_interval)
+
+def summarise(records, seconds):
+    latencies = np.array([r['latency'] for r in records]) if records else np.array([np.nan])
+    errors = [r for r in records if not r['ok']]
+    return {
+        'requests': len(records),
+        'throughput_per_second': len(records) / seconds,
+        'latency_p50_seconds': float(np.percentile(latencies, 50)),
+        'latency_p95_seconds': float(np.percentile(latencies, 95)),
+        'latency_p99_seconds': float(np.percentile(latencies, 99)),
+        'latency_max_seconds': float(latencies.max()),
+        'error_rate': len(errors) / len(records) if records else 0.0,
+        'errors': dict(collections.Counter(str(r['outcome']) for r in errors)),
+    }
+
+def gist_readings(fake, gist_id, name):
+    # every reading in the table's shards of the gist, as the mirror left it
+    shards = [pd.read_csv(io.StringIO(content), dtype=str)
+        for filename, content in fake.files(gist_id).items()
+        if filename.startswith(name + '-') and filename.endswith('.csv')]
+    return pd.concat(shards) if shards else pd.DataFrame(columns=['uid', 'timestamp', 'Timestamp'])
+
+def lost_writes(kits_sent, manual_sent, fake):
+    import store
+    enviro = store.read_readings('enviro_readings')
+    manual = store.read_readings('manual_readings')
+    gist_enviro = gist_readings(fake, offline.enviro_gist_id, 'enviro_readings')
+    gist_manual = gist_readings(fake, offline.manual_gist_id, 'manual_readings')
+    kits_sent = set(kits_sent)
+    manual_sent = collections.Counter(manual_sent)
+    def missing_manual(held):
+        held = collections.Counter(held)
+        return sum(max(n - held[t], 0) for t, n in manual_sent.items())
+    return {
+        'enviro_readings': {
+            'acknowledged': len(kits_sent),
+            'missing_from_store': len(kits_sent - set(zip(enviro['uid'], enviro['timestamp']))),
+            'missing_from_gist': len(kits_sent - set(zip(gist_enviro['uid'], gist_enviro['timestamp']))),
+        },
+        'manual_readings': {
+            'acknowledged': sum(manual_sent.values()),
+            'missing_from_store': missing_manual(manual['Timestamp']),
+            'missing_from_gist': missing_manual(gist_manual['Timestamp']),
+        },
+    }
+
+def run_load(args):
+    workdir = tempfile.mkdtemp(prefix='embs-loadtest-')
+    fake = offline.start_gists(args.days, delay=args.gist_delay)
+    offline.configure(fake, workdir, args.flush_interval)
+    import store
+    import mirror
+    for index in range(args.kits):
+        store.register_device(*kit_device(index), 'urban')
+    started = time.time()
+    server, url = start_server(args, fake, workdir)
+    startup_seconds = time.time() - started
+    graphs = graph_types(url)
+    # new readings follow on from the synthetic history
+    history_end = pd.Timestamp(synthetic.enviro_readings(args.days)['timestamp'].iloc[-1])
+    records = []
+    kits_sent = []
+    manual_sent = []
+    logged = len(fake.log)
+    started = time.time()
+    deadline = started + args.duration
+    threads = [threading.Thread(target=kit, args=(url, index, history_end + pd.Timedelta(minutes=15), deadline,
+            args, records, kits_sent)) for index in range(args.kits)]
+    threads += [threading.Thread(target=viewer, args=(url, graphs, deadline, args, records))
+        for _ in range(args.viewers)]
+    threads += [threading.Thread(target=submitter, args=(url, index, history_end.tz_localize(None)
+            + pd.Timedelta(days=1), deadline, args, records, manual_sent)) for index in range(args.submitters)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.time() - started
+    gist_requests = fake.log[logged:]
+    # give the workers' mirrors time to upload what they took, however far behind they fell
+    drain_started = time.time()
+    while (mirror.pending('enviro_readings') or mirror.pending('manual_readings')) \
+            and time.time() < drain_started + args.drain_timeout:
+        time.sleep(0.5)
+    drain_seconds = time.time() - drain_started
+    server.terminate()
+    server.wait()
+    fake.stop()
+    by_kind = collections.defaultdict(list)
+    for record in records:
+        by_kind[record['kind']].append(record)
+    return {
+        'workers': args.workers,
+        'kits': args.kits,
+        'viewers': args.viewers,
+        'submitters': args.submitters,
+        'startup_seconds': startup_seconds,
+        'duration_seconds': seconds,
+        'overall': summarise(records, seconds),
+        'requests': {kind: summarise(kind_records, seconds) for kind, kind_records in sorted(by_kind.items())},
+        'readings_acknowledged_per_second': len(kits_sent) / seconds,
+        'gist_requests': len(gist_requests),
+        'gist_patches': sum(r['method'] == 'PATCH' for r in gist_requests),
+        'gist_bytes_sent': sum(r['bytes_in'] for r in gist_requests),
+        'mirror_drain_seconds': drain_seconds,
+        'mirror_pending': bool(mirror.pending('enviro_readings') or mirror.pending('manual_readings')),
+        'lost_writes': lost_writes(kits_sent, manual_sent, fake),
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('workers', nargs='*', type=int, default=default_workers)
+    parser.add_argument('--kits', nargs='+', type=int, default=[20], help='numbers of kits to try with each number of workers')
+    parser.add_argument('--viewers', type=int, default=5)
+    parser.add_argument('--submitters', type=int, default=1)
+    parser.add_argument('--duration', type=float, default=60, help='seconds of traffic')
+    parser.add_argument('--days', type=int, default=365, help='days of history in the gists to begin with')
+    parser.add_argument('--batch', type=int, default=12, help='readings in each upload from a kit')
+    parser.add_argument('--kit-interval', type=float, default=5, help='seconds between uploads from each kit')
+    parser.add_argument('--view-interval', type=float, default=10, help='seconds between page loads by each viewer')
+    parser.add_argument('--polls', type=int, default=3, help='live updates each viewer waits for before loading the page again')
+    parser.add_argument('--live-interval', type=float, default=5, help='seconds between live updates')
+    parser.add_argument('--submit-interval', type=float, default=10, help='seconds between submits by each submitter')
+    parser.add_argument('--gist-delay', type=float, default=0.2, help='seconds the fake gist server takes to answer')
+    parser.add_argument('--flush-interval', type=float, default=5, help='seconds between uploads to the gists')
+    parser.add_argument('--drain-timeout', type=int, default=120)
+    parser.add_argument('--request-timeout', type=int, default=60)
+    parser.add_argument('--startup-timeout', type=int, default=600)
+    parser.add_argument('--output')
+    parser.add_argument('--single', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.single:
+        args.workers = args.workers[0]
+        args.kits = args.kits[0]
+        json.dump(run_load(args), sys.stdout)
+        sys.exit(0)
+    results = []
+    for workers, kits in itertools.product(args.workers, args.kits):
+        # a fresh interpreter for each combination, whose store and gists start from the same history
+        command = [sys.executable, os.path.abspath(__file__), '--single', str(workers), '--kits', str(kits)]
+        for name, value in vars(args).items():
+            if name not in ('workers', 'kits', 'output', 'single'):
+                command += ['--' + name.replace('_', '-'), str(value)]
+        output = subprocess.run(command, capture_output=True, text=True, check=True).stdout
+        results.append(json.loads(output))
+    settings = {name: value for name, value in vars(args).items() if name not in ('output', 'single')}
+    report = {'benchmark': 'load', 'environment': run.environment(), 'settings': settings, 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
+        sys.stdout.write('\n')
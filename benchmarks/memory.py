@@ -0,0 +1,52 @@
+# Memory use and filtering speed of the combined readings, in the typed layout built by
+# query.combine_readings against the layout pandas infers by itself.
+# Run from the repository root: python benchmarks/memory.py [days ...]
+import os
+import sys
+import json
+import time
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import store
+import query
+import synthetic
+
+def inferred_layout(manual, enviro):
+    # the layout combine_readings used to build: inferred float64 columns and a string Method
+    manual = manual.assign(Method='Manual', Timestamp=pd.to_datetime(manual['Timestamp'], utc=True))
+    enviro = enviro.rename(columns=store.combined_names['enviro_readings']).assign(Method='Enviro')
+    enviro['Timestamp'] = pd.to_datetime(enviro['Timestamp'], utc=True)
+    return pd.concat([manual, enviro])
+
+def best_time(call, repeat=5):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        call()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def measure(days):
+    manual = synthetic.manual_readings(days)
+    enviro = synthetic.enviro_readings(days).drop(columns=['voltage'])
+    inferred = inferred_layout(manual, enviro)
+    typed = query.combine_readings(manual, enviro)
+    # the last week of Enviro readings, as a zoomed graph asks for
+    end = typed.index.max()
+    start = end - pd.Timedelta(days=7)
+    return {
+        'days': days,
+        'rows': len(typed),
+        'inferred_bytes': int(inferred.memory_usage(deep=True).sum()),
+        'typed_bytes': int(typed.memory_usage(deep=True).sum()),
+        'inferred_filter_seconds': best_time(lambda: inferred[(inferred['Method'] == 'Enviro')
+            & (inferred['Timestamp'] >= start) & (inferred['Timestamp'] <= end)]),
+        'typed_filter_seconds': best_time(lambda: (lambda data: data[data['Method'] == 'Enviro'])(
+            query.select_range(typed, start, end))),
+    }
+
+if __name__ == '__main__':
+    results = [measure(int(days)) for days in (sys.argv[1:] or [30, 365, 3 * 365])]
+    json.dump({'benchmark': 'memory', 'results': results}, sys.stdout, indent=1)
+    sys.stdout.write('\n')
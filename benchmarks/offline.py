@@ -0,0 +1,49 @@
+# Runs the app against a local fake gist server and a scratch store, so benchmarks and
+# load tests need no network, no GitHub token and never touch the real data.
+import os
+import sys
+import types
+import importlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import fake_gist
+import synthetic
+
+manual_gist_id = 'e7c8598e3ba54bf86f0586c745026918'
+enviro_gist_id = 'b961b551f676f0e7511cfccd475912e9'
+
+def start_gists(days, manual_per_week=3, delay=0.0):
+    # the fake server holds days of synthetic readings in the legacy single file layout,
+    # as a first deploy would find them
+    fake = fake_gist.FakeGist(delay=delay)
+    fake.start()
+    enviro = synthetic.enviro_readings(days).drop(columns=['voltage'])
+    manual = synthetic.manual_readings(days, manual_per_week)
+    fake.create(enviro_gist_id, {'enviro_readings.csv': enviro.to_csv(index=False)})
+    fake.create(manual_gist_id, {'manual_readings.csv': manual.to_csv(index=False)})
+    return fake
+
+def configure(fake, workdir, flush_interval=3600):
+    # point the app's modules at the fake server and workdir before app itself is imported
+    cred = types.ModuleType('cred')
+    # a placeholder token; nothing leaves this machine
+    cred.github_pat = 'offline'
+    sys.modules['cred'] = cred
+    import gist_client
+    import store
+    import readings_cache
+    import figure_cache
+    import mirror
+    import metrics
+    import singleflight
+    gist_client.api_url = fake.url
+    store.db_path = os.path.join(workdir, 'embs.db')
+    readings_cache.cache_dir = os.path.join(workdir, 'cache')
+    figure_cache.cache_dir = os.path.join(workdir, 'cache', 'figures')
+    mirror.flush_interval = flush_interval
+    metrics.metrics_dir = os.path.join(workdir, 'cache', 'metrics')
+    singleflight.lock_dir = os.path.join(workdir, 'cache', 'locks')
+
+def import_app():
+    # dash builds the layout once on import, which seeds the manual readings from the gist
+    return importlib.import_module('app')
@@ -0,0 +1,203 @@
+# Latency, peak memory and payload size of each stage of the app, from seeding the store
+# to drawing the graphs and taking new readings, across sizes of synthetic history.
+# Runs offline against a local fake gist server; every size runs in a fresh process.
+# Run from the repository root: python benchmarks/run.py [--output results.json] [days ...]
+import os
+import sys
+import gc
+import gzip
+import json
+import math
+import time
+import argparse
+import itertools
+import platform
+import tempfile
+import statistics
+import subprocess
+import tracemalloc
+import pandas as pd
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+import offline
+import synthetic
+
+default_days = [30, 365, 3 * 365]
+
+def measure(stage, call, repeat, fake=None, payload=None, after=None):
+    # call is timed repeat times untraced, then once more under tracemalloc for its peak memory;
+    # stages that only happen once (repeat=0) take their latency from the traced run.
+    # after runs untimed following each call
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        call()
+        times.append(time.perf_counter() - start)
+        if after is not None:
+            after()
+    logged = len(fake.log) if fake is not None else 0
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = call()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    if after is not None:
+        after()
+    result_row = {
+        'stage': stage,
+        'runs': len(times) or 1,
+        'latency_min_seconds': min(times or [elapsed]),
+        'latency_median_seconds': statistics.median(times or [elapsed]),
+        'peak_memory_bytes': peak,
+    }
+    if payload is not None:
+        result_row['payload_bytes'] = payload(result)
+    if fake is not None:
+        # traffic to and from the gists during the traced run
+        requests = fake.log[logged:]
+        result_row['gist_requests'] = len(requests)
+        result_row['gist_bytes_sent'] = sum(r['bytes_in'] for r in requests)
+        result_row['gist_bytes_received'] = sum(r['bytes_out'] for r in requests)
+    return result_row
+
+def settle(figure_cache):
+    # wait for figures being redrawn in the background, so they are not timed with the next stage
+    while figure_cache._refreshing:
+        time.sleep(0.01)
+
+def graph_request(graph_type, relayout_data=None):
+    return {
+        'output': '..plot-' + graph_type + '.figure...plot-' + graph_type + '.className...drawn-'
+            + graph_type + '.data..',
+        'outputs': [{'id': 'plot-' + graph_type, 'property': 'figure'},
+            {'id': 'plot-' + graph_type, 'property': 'className'},
+            {'id': 'drawn-' + graph_type, 'property': 'data'}],
+        'inputs': [{'id': 'tabs', 'property': 'value', 'value': 'view-graphs'},
+            {'id': 'device-filter', 'property': 'value', 'value': None},
+            {'id': 'live-redraw', 'property': 'data', 'value': None},
+            {'id': 'plot-' + graph_type, 'property': 'relayoutData', 'value': relayout_data}],
+        'state': [{'id': 'plot-' + graph_type, 'property': 'className', 'value': None}],
+        'changedPropIds': ['plot-' + graph_type + '.relayoutData' if relayout_data else 'tabs.value'],
+    }
+
+def run_size(days, repeat):
+    workdir = tempfile.mkdtemp(prefix='embs-benchmark-')
+    fake = offline.start_gists(days)
+    offline.configure(fake, workdir)
+    stages = []
+    stages.append(measure('import_app', offline.import_app, 0, fake))
+    app = sys.modules['app']
+    import store
+    import query
+    import figure_cache
+    stages.append(measure('seed_store', app.seed_store, 0, fake))
+    manual = app.read_manual_readings()
+    enviro = app.read_enviro_readings()
+    stages.append(measure('read_store', lambda: (app.read_manual_readings(), app.read_enviro_readings()), repeat))
+    stages.append(measure('combine_readings', lambda: query.combine_readings(manual, enviro), repeat,
+        payload=lambda data: int(data.memory_usage(deep=True).sum())))
+    stages.append(measure('read_graph_readings', app.read_graph_readings, repeat,
+        payload=lambda data: int(data.memory_usage(deep=True).sum())))
+    graph_readings = app.get_graph_readings()
+    for graph_type in app.plot_settings:
+        stages.append(measure('plot_readings:' + graph_type,
+            lambda: app.plot_readings(graph_type, graph_readings), repeat,
+            payload=lambda figure: len(figure.to_json())))
+    client = app.server.test_client()
+    stages.append(measure('serve_layout', lambda: client.get('/_dash-layout'), repeat,
+        payload=lambda response: len(response.data)))
+    # the first graph drawn for a data version is built, later ones come from the figure cache
+    stages.append(measure('graph_callback_cold',
+        lambda: client.post('/_dash-update-component', json=graph_request('temperature')), 0,
+        payload=lambda response: len(response.data)))
+    stages.append(measure('graph_callback_cached',
+        lambda: client.post('/_dash-update-component', json=graph_request('temperature')), repeat,
+        payload=lambda response: len(response.data)))
+    end = pd.Timestamp(enviro['timestamp'].max())
+    zoom = {'xaxis.range[0]': str((end - pd.Timedelta(days=7)).tz_localize(None)),
+        'xaxis.range[1]': str(end.tz_localize(None))}
+    stages.append(measure('graph_callback_zoomed',
+        lambda: client.post('/_dash-update-component', json=graph_request('temperature', zoom)), repeat,
+        payload=lambda response: len(response.data)))
+    stages.append(measure('export_csv', lambda: client.get('/export?format=csv'), repeat,
+        payload=lambda response: len(response.data)))
+    stages.append(measure('api_readings', lambda: client.get('/api/readings?metric=Temperature&bucket=1D'), repeat,
+        payload=lambda response: len(response.data)))
+    # new readings follow on from the synthetic history, in a fresh month for every call
+    months = itertools.count(1)
+    def post(batch):
+        readings = synthetic.enviro_readings(math.ceil(batch / 96),
+            start=end + pd.Timedelta(days=31 * next(months)), seed=batch).head(batch)
+        return client.post('/envirodata', data=json.dumps(synthetic.enviro_payload(readings)))
+    for batch in [1, 96, 2016]:
+        stages.append(measure('receive_data:' + str(batch), lambda: post(batch), repeat,
+            payload=lambda response: response.request.content_length, after=lambda: settle(figure_cache)))
+    # a week's backlog from a kit's own csv file, gzipped, in one request
+    def post_bulk():
+        readings = synthetic.enviro_readings(7, start=end + pd.Timedelta(days=31 * next(months)), seed=7)
+        return client.post('/envirodata/bulk?uid=e6614103e75c6322', headers={'Content-Encoding': 'gzip'},
+            data=gzip.compress(synthetic.enviro_file_text(readings).encode('utf-8')))
+    stages.append(measure('receive_bulk:672', post_bulk, repeat,
+        payload=lambda response: response.request.content_length, after=lambda: settle(figure_cache)))
+    # a kit sending the same readings again after a failed upload
+    resent = json.dumps(synthetic.enviro_payload(synthetic.enviro_readings(1, start=end + pd.Timedelta(days=-1))))
+    stages.append(measure('receive_data_resent:96', lambda: client.post('/envirodata', data=resent), repeat,
+        payload=lambda response: response.request.content_length))
+    # the first upload moves the gist to monthly shards; later ones send only changed months
+    stages.append(measure('mirror_flush_first', app.mirror.flush, 0, fake))
+    post(96)
+    settle(figure_cache)
+    stages.append(measure('mirror_flush', app.mirror.flush, 0, fake))
+    return {
+        'days': days,
+        'manual_rows': store.count_readings('manual_readings'),
+        'enviro_rows': store.count_readings('enviro_readings'),
+        'stages': stages,
+    }
+
+def environment():
+    import numpy
+    import plotly
+    import dash
+    try:
+        revision = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+            cwd=root).stdout.strip() or None
+    except OSError:
+        revision = None
+    return {
+        'revision': revision,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'pandas': pd.__version__,
+        'numpy': numpy.__version__,
+        'plotly': plotly.__version__,
+        'dash': dash.__version__,
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('days', nargs='*', type=int, default=default_days)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output')
+    parser.add_argument('--single', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.single:
+        json.dump(run_size(args.days[0], args.repeat), sys.stdout)
+        sys.exit(0)
+    results = []
+    for days in args.days:
+        # a fresh interpreter for each size, so caches and memory from one do not affect the next
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), '--single',
+            '--repeat', str(args.repeat), str(days)], capture_output=True, text=True, check=True).stdout
+        results.append(json.loads(output))
+    report = {'benchmark': 'stages', 'environment': environment(), 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
+        sys.stdout.write('\n')
@@ -0,0 +1,54 @@
+import numpy as np
+import pandas as pd
+
+# the columns of an Enviro Urban readings file, as in 2023-01-24.txt
+enviro_file_columns = ['timestamp', 'temperature', 'humidity', 'pressure', 'noise', 'pm1', 'pm2_5', 'pm10', 'voltage']
+
+def enviro_readings(days, interval_minutes=15, start='2023-01-01', seed=0):
+    # plausible readings with a daily cycle, in the layout of an Enviro Urban readings file
+    rng = np.random.default_rng(seed)
+    timestamps = pd.date_range(start, periods=int(days * 24 * 60 / interval_minutes),
+        freq=str(interval_minutes) + 'min', tz='UTC')
+    n = len(timestamps)
+    daily = np.sin(2 * np.pi * (timestamps.hour + timestamps.minute / 60).to_numpy() / 24)
+    pm = rng.gamma(2, 4, n).round()
+    return pd.DataFrame({
+        'timestamp': timestamps.strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'temperature': (12 + 6 * daily + rng.normal(0, 1, n)).round(2),
+        'humidity': (60 - 15 * daily + rng.normal(0, 3, n)).round(2),
+        'pressure': (1013 + np.cumsum(rng.normal(0, 0.2, n)).clip(-60, 60)).round(2),
+        'noise': rng.uniform(0.01, 0.06, n).round(3),
+        'pm1': (pm * 0.5).round(),
+        'pm2_5': pm,
+        'pm10': pm + rng.gamma(2, 3, n).round(),
+        'voltage': 0.0,
+    }, columns=enviro_file_columns)
+
+def enviro_file_text(readings):
+    return readings.to_csv(index=False)
+
+def enviro_payload(readings, nickname='embsgarden', uid='e6614103e75c6322'):
+    # the json the upload_on_poke firmware posts to /envirodata, one object per reading
+    columns = enviro_file_columns[1:]
+    return [{
+        'nickname': nickname,
+        'timestamp': row[0],
+        'readings': dict(zip(columns, row[1:])),
+        'model': 'urban',
+        'uid': uid
+    } for row in readings.itertuples(index=False, name=None)]
+
+def manual_readings(days, per_week=3, start='2023-01-01', seed=0):
+    # readings typed in from the handheld monitor a few times a week
+    rng = np.random.default_rng(seed + 1)
+    n = max(1, int(days / 7 * per_week))
+    timestamps = pd.Timestamp(start) + pd.to_timedelta(np.sort(rng.uniform(0, days, n)), unit='D')
+    return pd.DataFrame({
+        'Timestamp': timestamps.floor('min').strftime('%Y-%m-%d %H:%M:%S'),
+        'Temperature': rng.integers(0, 30, n),
+        'Humidity': rng.integers(30, 90, n),
+        'AQI': rng.integers(0, 80, n),
+        'PM2.5': rng.uniform(0, 30, n).round(1),
+        'PM10': rng.uniform(0, 50, n).round(1),
+        'TVOC': rng.uniform(0, 1, n).round(2),
+    })
@@ -0,0 +1,43 @@
+import numpy as np
+import pandas as pd
+
+def lttb(x, y, threshold):
+    # Largest-Triangle-Three-Buckets: returns the positions of the points to keep
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    # the first and last points are always kept, the rest are split into equal buckets
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+    a = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        if i + 2 < len(edges):
+            next_x = x[end:edges[i + 2]].mean()
+            next_y = y[end:edges[i + 2]].mean()
+        else:
+            next_x = x[n - 1]
+            next_y = y[n - 1]
+        # keep the point making the largest triangle with the last kept point and the next bucket's average
+        area = np.abs((x[a] - next_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (next_y - y[a]))
+        a = start + int(np.argmax(area))
+        selected[i + 1] = a
+    return selected
+
+def downsample_readings(data, y, group, max_points):
+    # data is indexed by time in order; max_points is split between the groups (e.g. Methods)
+    # in proportion to their size
+    data = data[data[y].notna()]
+    total = len(data)
+    if total <= max_points:
+        return data
+    parts = []
+    for _, part in data.groupby(group, sort=False, observed=True):
+        budget = max(3, int(max_points * len(part) / total))
+        seconds = (part.index - part.index[0]).total_seconds().to_numpy()
+        parts.append(part.iloc[lttb(seconds, part[y].to_numpy(), budget)])
+    return pd.concat(parts)
@@ -0,0 +1,38 @@
+import io
+import csv
+import json
+import zlib
+import store
+
+formats = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+metric_names = [c for c in store.combined_columns if c not in ('Timestamp', 'Method')]
+
+def _text_chunks(format, start, end, method, metrics, devices):
+    columns = ['Timestamp', 'Method', 'Device'] + metrics
+    if format == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator='\n')
+        writer.writerow(columns)
+        for rows in store.iter_combined_readings(start, end, method, metrics, devices):
+            writer.writerows(rows)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+    else:
+        for rows in store.iter_combined_readings(start, end, method, metrics, devices):
+            yield ''.join(json.dumps(dict(zip(columns, row))) + '\n' for row in rows)
+
+def stream_readings(format, compress, start=None, end=None, method=None, metrics=None, devices=None):
+    # yields the export a chunk at a time, gzipped if asked, so memory use does not grow with the range
+    metrics = metrics or metric_names
+    chunks = (chunk.encode('utf-8') for chunk in _text_chunks(format, start, end, method, metrics, devices))
+    if not compress:
+        yield from chunks
+        return
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
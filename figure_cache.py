@@ -0,0 +1,108 @@
+import os
+import glob
+import json
+import threading
+import metrics
+import singleflight
+
+# serialised figures, shared by all gunicorn workers
+cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'figures')
+# least recently used figures are removed beyond this many
+max_entries = 50
+
+_refreshing = set()
+_lock = threading.Lock()
+
+def _path(key, version):
+    return os.path.join(cache_dir, key + '@' + version + '.json')
+
+def _read(path):
+    try:
+        with open(path, 'r') as f:
+            figure = f.read()
+    except OSError:
+        return None
+    # mark as recently used
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    return figure
+
+def _write(path, figure):
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = path + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(figure)
+    os.replace(tmp, path)
+    _evict()
+
+def _evict():
+    paths = glob.glob(os.path.join(cache_dir, '*.json'))
+    if len(paths) <= max_entries:
+        return
+    paths.sort(key=lambda path: os.stat(path).st_mtime if os.path.exists(path) else 0)
+    for path in paths[:len(paths) - max_entries]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def _latest_stale(key):
+    paths = glob.glob(os.path.join(cache_dir, glob.escape(key) + '@*.json'))
+    paths.sort(key=lambda path: os.stat(path).st_mtime if os.path.exists(path) else 0)
+    for path in reversed(paths):
+        figure = _read(path)
+        if figure is not None:
+            return figure
+    return None
+
+def _build(key, version, build):
+    with metrics.span('figure_build', figure=key):
+        figure = build().to_json()
+    _write(_path(key, version), figure)
+    return figure
+
+def _refresh(key, version, build):
+    try:
+        warm(key, version, build)
+    finally:
+        with _lock:
+            _refreshing.discard((key, version))
+
+def refresh(key, version, build):
+    # rebuild in the background, unless this worker is already doing so
+    with _lock:
+        if (key, version) in _refreshing or os.path.exists(_path(key, version)):
+            return
+        _refreshing.add((key, version))
+    threading.Thread(target=_refresh, args=(key, version, build), daemon=True).start()
+
+def warm(key, version, build):
+    # build now, rather than in the background, unless the figure is already cached
+    # or another worker builds it meanwhile
+    with singleflight.flight('figure-' + key):
+        if not os.path.exists(_path(key, version)):
+            _build(key, version, build)
+
+def get_figure(key, version, build):
+    # returns the figure as a dict, calling build only when nothing cached can be served
+    figure = _read(_path(key, version))
+    if figure is None:
+        # serve an older version while a fresh one is built
+        figure = _latest_stale(key)
+        if figure is None:
+            # callers arriving together, in any worker, wait for one of them to build it
+            with singleflight.flight('figure-' + key):
+                figure = _read(_path(key, version))
+                if figure is None:
+                    metrics.count('cache_requests_total', cache='figure', result='miss')
+                    figure = _build(key, version, build)
+                else:
+                    metrics.count('cache_requests_total', cache='figure', result='shared')
+        else:
+            metrics.count('cache_requests_total', cache='figure', result='stale')
+            refresh(key, version, build)
+    else:
+        metrics.count('cache_requests_total', cache='figure', result='hit')
+    return json.loads(figure)
@@ -0,0 +1,107 @@
+import os
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests as req
+from requests.adapters import HTTPAdapter
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
+# store credentials in a file called cred.py in root folder
+import cred
+import metrics
+
+api_url = 'https://api.github.com'
+manual_gist_id = 'e7c8598e3ba54bf86f0586c745026918'
+enviro_gist_id = 'b961b551f676f0e7511cfccd475912e9'
+
+# below this many requests left in the rate limit window, calls are spread out over the rest of it
+rate_limit_reserve = 100
+# longest a single call will wait for the rate limit
+max_throttle = 10
+timeout = 30
+
+rate_limit = {'remaining': None, 'reset': 0}
+
+_shared_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+class GistUnavailable(req.HTTPError):
+    pass
+
+def _session():
+    # one pooled keep-alive session per process, and never one inherited from a parent process
+    global _session_pid, _shared_session
+    with _session_lock:
+        if _session_pid != os.getpid():
+            session = req.Session()
+            session.headers.update({
+                'Accept': 'application/vnd.github+json',
+                'Authorization': 'Bearer ' + cred.github_pat,
+                'X-GitHub-Api-Version': '2022-11-28'})
+            session.mount('https://', HTTPAdapter(pool_maxsize=8))
+            _shared_session = session
+            _session_pid = os.getpid()
+        return _shared_session
+
+def _throttle():
+    remaining = rate_limit['remaining']
+    if remaining is None or remaining > rate_limit_reserve:
+        return
+    # spread what is left evenly across the rest of the window
+    wait = max(0, rate_limit['reset'] - time.time()) / max(remaining, 1)
+    time.sleep(min(wait, max_throttle))
+
+def _record_rate_limit(response):
+    if 'X-RateLimit-Remaining' in response.headers:
+        rate_limit['remaining'] = int(response.headers['X-RateLimit-Remaining'])
+        rate_limit['reset'] = int(response.headers.get('X-RateLimit-Reset', 0))
+        metrics.gauge('github_rate_limit_remaining', rate_limit['remaining'])
+
+@retry(retry=retry_if_exception_type((req.ConnectionError, req.Timeout, GistUnavailable)),
+    wait=wait_exponential(multiplier=0.5, max=8), stop=stop_after_attempt(4), reraise=True)
+def _send(method, url, **kwargs):
+    _throttle()
+    with metrics.span('gist_request', method=method):
+        response = _session().request(method, url, timeout=timeout, **kwargs)
+    _record_rate_limit(response)
+    metrics.count('gist_requests_total', method=method, status=response.status_code)
+    metrics.count('gist_bytes_total', len(kwargs.get('data') or ''), direction='sent')
+    metrics.count('gist_bytes_total', len(response.content), direction='received')
+    # server errors and secondary rate limits are worth another try
+    if response.status_code >= 500 or response.status_code == 429 or (
+            response.status_code == 403 and rate_limit['remaining'] == 0):
+        raise GistUnavailable(str(response.status_code) + ' from ' + url, response=response)
+    return response
+
+def get_gist(gist_id, etag=None):
+    # a 304 response means the gist has not changed since etag
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    response = _send('GET', api_url + '/gists/' + gist_id, headers=headers)
+    if response.status_code != 304:
+        response.raise_for_status()
+    return response
+
+def patch_gist(gist_id, files):
+    response = _send('PATCH', api_url + '/gists/' + gist_id, data=json.dumps({'files': files}))
+    response.raise_for_status()
+    return response.json()
+
+def get_gist_revision(gist_id, revision):
+    # the gist as it was at a revision from its history
+    response = _send('GET', api_url + '/gists/' + gist_id + '/' + revision)
+    response.raise_for_status()
+    return response.json()
+
+def get_raw(url):
+    # the full content of a file whose inline content was truncated
+    response = _send('GET', url)
+    response.raise_for_status()
+    return response.text
+
+def fetch_concurrently(calls):
+    # runs each call on its own thread, so the total wait is the slowest call rather than the sum
+    with ThreadPoolExecutor(max_workers=max(len(calls), 1)) as executor:
+        return list(executor.map(lambda call: call(), calls))
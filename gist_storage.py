@@ -0,0 +1,207 @@
+import io
+import json
+import pandas as pd
+import gist_client
+import readings_cache
+import store
+
+# each table is kept in its gist as one csv file per device per month, listed in a manifest,
+# so uploads from different kits write to different files
+manifest_version = 2
+# a device's months from years before the latest it has readings in are folded into one file a
+# year, once, so a gist keeps to twelve files a kit and one a year; GitHub lists at most 300 files
+# times a save is tried when other writers keep changing the gist under it
+max_attempts = 3
+
+class GistConflict(Exception):
+    pass
+
+def manifest_name(name):
+    return name + '-manifest.json'
+
+def shard_name(name, period, device=''):
+    # period is YYYY-MM, or YYYY for a folded year; device is '' for tables without devices, and
+    # for months from before readings were split by device
+    return name + ('-' + device if device else '') + '-' + period + '.csv'
+
+def legacy_name(name):
+    # the single file used before the readings were split by month
+    return name + '.csv'
+
+def _overlaps(shard, start, end):
+    return (start is None or shard['end'] >= start) and (end is None or shard['start'] <= end)
+
+def load_readings(gist_id, name, start=None, end=None):
+    # only the shards overlapping start and end (utc iso strings) are read, at the same time
+    gist = readings_cache.load_gist(gist_id)
+    if manifest_name(name) not in gist['files']:
+        return readings_cache.load_gist_csv(gist_id, legacy_name(name))
+    manifest = json.loads(readings_cache.load_gist_text(gist_id, manifest_name(name)))
+    shards = [filename for filename, shard in sorted(manifest['shards'].items())
+        if _overlaps(shard, start, end)]
+    frames = gist_client.fetch_concurrently(
+        [lambda filename=filename: readings_cache.load_gist_csv(gist_id, filename) for filename in shards])
+    if not frames:
+        return pd.DataFrame(columns=store.tables[name])
+    return pd.concat(frames, ignore_index=True)
+
+def _revision_key(name):
+    # the gist revision this store last wrote, and the raw_url of each file as it left them
+    return 'gist_revision_' + name
+
+def _merge_files(name, files, filenames, base):
+    # readings in the named csv files that the store does not hold yet are added to it. A table
+    # without a key cannot tell a row edited or deleted here from one added elsewhere, so it only
+    # takes the rows a file has gained since base, which maps each file to the raw_url of the copy
+    # both writers started from
+    for filename in filenames:
+        data = _read_file(files[filename])
+        if store.unique_keys[name] is None and filename in base:
+            data = _added_rows(data, pd.read_csv(io.StringIO(gist_client.get_raw(base[filename]))))
+        store.merge_readings(name, data)
+
+def _read_text(file):
+    if file.get('truncated') or file.get('content') is None:
+        return gist_client.get_raw(file['raw_url'])
+    return file['content']
+
+def _read_file(file):
+    return pd.read_csv(io.StringIO(_read_text(file)))
+
+def _added_rows(data, base):
+    # the rows of data not in base, a row repeated in data counting once for each time it is
+    columns = list(data.columns)
+    data = data.assign(occurrence=data.groupby(columns, dropna=False).cumcount())
+    base = base.reindex(columns=columns)
+    base = base.assign(occurrence=base.groupby(columns, dropna=False).cumcount())
+    return pd.concat([base, base, data]).drop_duplicates(keep=False).drop(columns=['occurrence'])
+
+def _period(filename):
+    # shard files end -YYYY-MM.csv, or -YYYY.csv for a folded year
+    stem = filename[:-4]
+    return stem[-7:] if stem[-3] == '-' else stem[-4:]
+
+def _shard_files(name, files):
+    return [filename for filename in files
+        if filename.startswith(name + '-') and filename.endswith('.csv')]
+
+def _merge_changed(gist_id, name, gist):
+    # another writer has changed the gist since this store last wrote it, so the shards it
+    # changed are merged in before any are written over
+    last = store.get_meta(_revision_key(name))
+    if last is None or gist['revision'] is None:
+        return
+    last = json.loads(last)
+    if last['revision'] == gist['revision']:
+        return
+    changed = [filename for filename in _shard_files(name, gist['files'])
+        if last['files'].get(filename) != gist['files'][filename]['raw_url']]
+    _merge_files(name, gist['files'], changed, last['files'])
+
+def save_readings(gist_id, name, partitions):
+    # upload just the named (device, month) partitions from the store, so the size of a write
+    # does not grow with history or with the number of kits. Another writer's changes are merged
+    # into the store first, and if one lands between reading the gist and writing it, the files
+    # it wrote are merged and the partitions written again. The gist is only downloaded when it
+    # is not the one this store last wrote
+    partitions = set(partitions)
+    for _ in range(max_attempts):
+        gist = _current_gist(gist_id, name)
+        _merge_changed(gist_id, name, gist)
+        partitions, written, response = _write(gist_id, name, gist, partitions)
+        readings_cache.remember_gist(gist_id, response)
+        history = [entry['version'] for entry in response.get('history', [])]
+        store.set_meta(store.connect(), _revision_key(name), json.dumps({
+            'revision': history[0] if history else None,
+            'files': {filename: file['raw_url'] for filename, file in response['files'].items()}}))
+        # files another writer changed since the gist was read, and ours left alone
+        base = {filename: file['raw_url'] for filename, file in gist['files'].items()}
+        _merge_files(name, response['files'], [filename for filename in _shard_files(name, response['files'])
+            if filename not in written and base.get(filename) != response['files'][filename]['raw_url']], base)
+        if len(history) < 2 or gist['revision'] is None or gist['revision'] in history[:2]:
+            # ours directly follows the revision we read, or, if the PATCH changed nothing,
+            # GitHub made no new revision and nothing was committed
+            return
+        # the revision before ours is not the one we read: another writer's files may have been
+        # replaced by ours, and its shards left out of our manifest, so the months it changed are
+        # merged and written again
+        theirs = gist_client.get_gist_revision(gist_id, history[1])['files']
+        changed = [filename for filename in _shard_files(name, theirs) if filename not in gist['files']
+            or gist['files'][filename]['raw_url'] != theirs[filename]['raw_url']]
+        _merge_files(name, theirs, changed, base)
+        periods = set(_period(filename) for filename in changed)
+        partitions = {partition for partition in store.partitions(name)
+            if partition[1] in periods or partition[1][:4] in periods}
+        if not partitions:
+            return
+    raise GistConflict('gist ' + gist_id + ' kept changing while ' + name + ' was being saved')
+
+def _monthly(manifest, device):
+    # the months the device has a file each for
+    return [shard['month'] for shard in manifest['shards'].values()
+        if shard['device'] == device and 'month' in shard]
+
+def _remove(gist, manifest, files, filename):
+    manifest['shards'].pop(filename, None)
+    if filename in gist['files']:
+        files[filename] = None
+
+def _current_gist(gist_id, name):
+    # the gist as this store last wrote it is written over without downloading it again: if
+    # another writer has changed it since, the revision before ours says so and its files are
+    # merged then. Otherwise GitHub is asked, with a conditional request, rather than trust the cache
+    last = store.get_meta(_revision_key(name))
+    gist = readings_cache.cached_gist(gist_id)
+    if last is not None and gist is not None and gist['revision'] == json.loads(last)['revision']:
+        return gist
+    readings_cache.invalidate(gist_id)
+    return readings_cache.load_gist(gist_id)
+
+def _write(gist_id, name, gist, partitions):
+    # returns the partitions written, the files sent and the gist as the PATCH left it
+    files = {}
+    partitions = set(partitions)
+    if manifest_name(name) in gist['files']:
+        manifest = json.loads(_read_text(gist['files'][manifest_name(name)]))
+    else:
+        # first sharded save: write every partition and remove the old single file
+        manifest = {'version': manifest_version, 'shards': {}}
+        partitions = set(store.partitions(name))
+        if legacy_name(name) in gist['files']:
+            files[legacy_name(name)] = None
+    for device, month in list(partitions):
+        if device and shard_name(name, month) in manifest['shards']:
+            # a month still in one file for every device is split up the first time it is written
+            partitions |= set(store.partitions(name, month)) | {('', month)}
+    manifest['version'] = manifest_version
+    # the months undivided by device only have their files removed, and are never folded
+    undivided = bool(store.source_columns[name])
+    recent = {}
+    for device in set(device for device, _ in partitions):
+        months = set(_monthly(manifest, device)) | set(month for written, month in partitions if written == device)
+        recent[device] = [month for month in months if month[:4] == max(months)[:4]]
+        if device or not undivided:
+            # months of a year that has ended are moved into its file
+            partitions |= set((device, month) for month in months if month not in recent[device])
+    shards = {}
+    for device, month in sorted(partitions):
+        filename = shard_name(name, month, device)
+        if month in recent[device] or (undivided and not device):
+            shards[filename] = (device, month)
+            continue
+        _remove(gist, manifest, files, filename)
+        shards[shard_name(name, month[:4], device)] = (device, month[:4])
+    for filename, (device, period) in sorted(shards.items()):
+        data = store.read_partition(name, device, period)
+        timestamp = data[store.tables[name][0]]
+        if len(period) == 4:
+            data = data[~timestamp.str[:7].isin(recent[device])]
+            timestamp = data[store.tables[name][0]]
+        if len(data) == 0:
+            _remove(gist, manifest, files, filename)
+            continue
+        manifest['shards'][filename] = {('month' if len(period) == 7 else 'year'): period, 'device': device,
+            'rows': len(data), 'start': timestamp.min(), 'end': timestamp.max()}
+        files[filename] = {'content': data.to_csv(index=False)}
+    files[manifest_name(name)] = {'content': json.dumps(manifest, indent=1, sort_keys=True)}
+    return partitions, set(files), gist_client.patch_gist(gist_id, files)
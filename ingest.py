@@ -0,0 +1,84 @@
+import io
+import pandas as pd
+
+reading_columns = ['temperature', 'humidity', 'pressure', 'noise', 'pm1', 'pm2_5', 'pm10']
+source_columns = ['nickname', 'uid', 'model', 'timestamp']
+# formats the bulk upload takes: the csv a kit keeps of its readings, or one reading object per line
+bulk_formats = ['csv', 'ndjson']
+
+def parse_enviro_readings(allreadings, devices):
+    # flatten and type the whole batch in one go, rather than a frame per reading;
+    # devices is the registry of kits (uid, nickname, model), and readings from any other kit are ignored
+    is_object = pd.Series([isinstance(line, dict) for line in allreadings], dtype=bool)
+    items = pd.json_normalize([line if isinstance(line, dict) else {} for line in allreadings])
+    items = items.reindex(columns=source_columns + ['readings.' + c for c in reading_columns])
+    items.columns = source_columns + reading_columns
+    items.index = is_object.index
+    data, error = _check_readings(items, devices)
+    return data[error.isna()], _rejected(error.mask(~is_object, 'not a reading'))
+
+def parse_enviro_table(items, devices, uid=None, nickname=None):
+    # readings already in columns, as read by read_chunks; readings that do not say which kit
+    # they are from are taken to be from the kit with uid or nickname, and a kit named by its uid
+    # alone need not give its nickname
+    if 'readings' in items:
+        readings = pd.DataFrame([r if isinstance(r, dict) else {} for r in items['readings']], index=items.index)
+        items = items.drop(columns=['readings']).join(readings.drop(columns=items.columns, errors='ignore'))
+    items = items.reindex(columns=source_columns + reading_columns)
+    items['uid'] = items['uid'].where(items['uid'].notna(), uid)
+    items['nickname'] = items['nickname'].where(items['nickname'].notna(), nickname)
+    registered = devices.set_index('uid')['nickname']
+    items['nickname'] = items['nickname'].fillna(items['uid'].map(registered))
+    data, error = _check_readings(items, devices)
+    return data[error.isna()], _rejected(error)
+
+class InvalidBody(Exception):
+    pass
+
+def read_chunks(body, format, chunk_rows):
+    # frames of up to chunk_rows readings from a binary stream, parsed as they are read, each
+    # indexed by the position of its readings in the whole body; raises InvalidBody if the
+    # stream cannot be read as the format
+    text = io.TextIOWrapper(body, encoding='utf-8')
+    try:
+        if format == 'csv':
+            # columns the kit keeps that are not readings, such as voltage, are not read
+            reader = pd.read_csv(text, chunksize=chunk_rows, dtype={'timestamp': str},
+                usecols=lambda c: c in source_columns + reading_columns)
+        else:
+            reader = pd.read_json(text, lines=True, chunksize=chunk_rows, dtype=False, convert_dates=False)
+        for items in reader:
+            yield items
+    except pd.errors.EmptyDataError:
+        return
+    except (ValueError, OSError, EOFError) as e:
+        # including bodies that are not valid gzip or utf-8
+        raise InvalidBody(str(e))
+
+def _check_readings(items, devices):
+    # items has the source_columns and reading_columns, as sent; returns the typed readings
+    # and the first problem with each, if any
+    # a reading without a uid is taken to be from the kit with its nickname
+    items['uid'] = items['uid'].where(items['uid'].notna(),
+        items['nickname'].map(devices.drop_duplicates('nickname').set_index('nickname')['uid']))
+    registered = devices.set_index('uid')
+
+    data = items[reading_columns].apply(pd.to_numeric, errors='coerce')
+    data.insert(0, 'timestamp', pd.to_datetime(items['timestamp'], utc=True, errors='coerce'))
+    # the kit's uid is part of each reading's key, so a resent reading is recognised
+    data['uid'] = items['uid'].where(items['uid'].isna(), items['uid'].astype(str))
+    known = data['uid'].isin(registered.index)
+    nickname = data['uid'].map(registered['nickname'])
+    model = data['uid'].map(registered['model'])
+
+    # later checks take priority, so the first problem with each reading is the one reported
+    error = pd.Series(None, index=items.index, dtype=object)
+    for c in reversed(reading_columns):
+        error = error.mask(data[c].isna(), 'invalid ' + c)
+    error = error.mask(data['timestamp'].isna(), 'invalid timestamp')
+    error = error.mask(items['model'].notna() & (items['model'] != model), 'invalid model')
+    error = error.mask(~known | (items['nickname'] != nickname), 'invalid source')
+    return data, error
+
+def _rejected(error):
+    return [{'index': int(i), 'error': e} for i, e in error.dropna().items()]
@@ -0,0 +1,203 @@
+import os
+import json
+import glob
+import time
+import threading
+
+# set to True to record timings and counts and serve them at /metrics
+enabled = False
+# each process writes its totals here, so any gunicorn worker can report them all
+metrics_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'metrics')
+# longest a process's latest numbers wait before being written for the other workers
+snapshot_interval = 5
+# snapshots untouched for this many seconds are removed, in case their pid has been reused
+snapshot_max_age = 7 * 24 * 3600
+# upper bounds, in seconds, of the latency histogram buckets
+buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+prefix = 'embs_'
+
+_counters = {}
+_gauges = {}
+_histograms = {}
+_lock = threading.Lock()
+_process = {'pid': None, 'started': None, 'timer': None}
+
+def _after_fork():
+    # a thread of the parent may have held the lock when it forked
+    global _lock
+    _lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_after_fork)
+
+def _key(name, labels):
+    return (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+
+def _changed():
+    # called with _lock held; after a fork the child starts with empty totals of its own
+    if _process['pid'] != os.getpid():
+        _counters.clear()
+        _gauges.clear()
+        _histograms.clear()
+        _process.update(pid=os.getpid(), started=time.time(), timer=None)
+    if _process['timer'] is None:
+        timer = threading.Timer(snapshot_interval, _write_snapshot)
+        timer.daemon = True
+        _process['timer'] = timer
+        timer.start()
+
+def count(name, value=1, **labels):
+    if not enabled:
+        return
+    key = _key(name, labels)
+    with _lock:
+        _changed()
+        _counters[key] = _counters.get(key, 0) + value
+
+def gauge(name, value, **labels):
+    if not enabled:
+        return
+    key = _key(name, labels)
+    with _lock:
+        _changed()
+        _gauges[key] = (value, time.time())
+
+def observe(name, seconds, **labels):
+    if not enabled:
+        return
+    key = _key(name, labels)
+    with _lock:
+        _changed()
+        histogram = _histograms.setdefault(key, {'buckets': [0] * len(buckets), 'sum': 0.0, 'count': 0})
+        for i, bound in enumerate(buckets):
+            if seconds <= bound:
+                histogram['buckets'][i] += 1
+                break
+        histogram['sum'] += seconds
+        histogram['count'] += 1
+
+class _Span:
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.name + '_seconds', time.perf_counter() - self.start, **self.labels)
+        return False
+
+class _NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_no_span = _NoSpan()
+
+def span(name, **labels):
+    # times the block into the name_seconds histogram
+    if not enabled:
+        return _no_span
+    return _Span(name, labels)
+
+def _snapshot():
+    with _lock:
+        _process['timer'] = None
+        if _process['pid'] != os.getpid():
+            return None
+        return {
+            'counters': [[name, dict(labels), value] for (name, labels), value in _counters.items()],
+            'gauges': [[name, dict(labels), value, at] for (name, labels), (value, at) in _gauges.items()],
+            'histograms': [[name, dict(labels), h['buckets'], h['sum'], h['count']]
+                for (name, labels), h in _histograms.items()],
+        }
+
+def _snapshot_path():
+    # named by start time as well as pid, so a later process reusing the pid keeps its own file
+    return os.path.join(metrics_dir, str(_process['pid']) + '-' + str(int(_process['started'] * 1000)) + '.json')
+
+def _write_snapshot():
+    snapshot = _snapshot()
+    if snapshot is None:
+        return
+    os.makedirs(metrics_dir, exist_ok=True)
+    path = _snapshot_path()
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(snapshot, f)
+    os.replace(tmp, path)
+
+def _process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _read_snapshots():
+    # the snapshots of processes still running; those of workers that have exited, from earlier
+    # deploys or recycling, are removed, so their totals drop out as a restart's would
+    snapshots = []
+    for path in glob.glob(os.path.join(metrics_dir, '*.json')):
+        try:
+            pid = int(os.path.basename(path).split('-')[0])
+            if not _process_exists(pid) or time.time() - os.path.getmtime(path) > snapshot_max_age:
+                os.remove(path)
+                continue
+            with open(path, 'r') as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            pass
+    return snapshots
+
+def _labels_text(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(k + '="' + v.replace('\\', '\\\\').replace('"', '\\"') + '"' for k, v in pairs) + '}'
+
+def render():
+    # the totals of every process, this one's up to the moment, in the Prometheus text format
+    if _process['pid'] == os.getpid():
+        _write_snapshot()
+    counters = {}
+    gauges = {}
+    histograms = {}
+    for snapshot in _read_snapshots():
+        for name, labels, value in snapshot['counters']:
+            key = _key(name, labels)
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, value, at in snapshot['gauges']:
+            # the most recently set value wins
+            key = _key(name, labels)
+            if key not in gauges or gauges[key][1] < at:
+                gauges[key] = (value, at)
+        for name, labels, counts, total, number in snapshot['histograms']:
+            key = _key(name, labels)
+            histogram = histograms.setdefault(key, {'buckets': [0] * len(buckets), 'sum': 0.0, 'count': 0})
+            histogram['buckets'] = [a + b for a, b in zip(histogram['buckets'], counts)]
+            histogram['sum'] += total
+            histogram['count'] += number
+    lines = []
+    for kind, values in [('counter', counters), ('gauge', gauges), ('histogram', histograms)]:
+        for name in sorted(set(name for name, _ in values)):
+            lines.append('# TYPE ' + prefix + name + ' ' + kind)
+            for (_, labels), value in sorted((key, value) for key, value in values.items() if key[0] == name):
+                if kind == 'counter':
+                    lines.append(prefix + name + _labels_text(labels) + ' ' + repr(value))
+                elif kind == 'gauge':
+                    lines.append(prefix + name + _labels_text(labels) + ' ' + repr(value[0]))
+                else:
+                    cumulative = 0
+                    for bound, number in zip(buckets, value['buckets']):
+                        cumulative += number
+                        lines.append(prefix + name + '_bucket' + _labels_text(labels, [('le', repr(float(bound)))]) + ' ' + str(cumulative))
+                    lines.append(prefix + name + '_bucket' + _labels_text(labels, [('le', '+Inf')]) + ' ' + str(value['count']))
+                    lines.append(prefix + name + '_sum' + _labels_text(labels) + ' ' + repr(value['sum']))
+                    lines.append(prefix + name + '_count' + _labels_text(labels) + ' ' + str(value['count']))
+    return '\n'.join(lines) + '\n'
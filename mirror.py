@@ -0,0 +1,66 @@
+import os
+import sys
+import time
+import fcntl
+import threading
+import store
+import metrics
+
+# seconds between uploads to the gists; all writes in between go up in one PATCH
+flush_interval = 30
+
+_savers = {}
+_started_pid = None
+
+def register(name, save):
+    # save uploads the given (device, month) partitions of the named table from the store
+    _savers[name] = save
+
+def start():
+    # one background writer per process, started again after a fork
+    global _started_pid
+    if _started_pid == os.getpid():
+        return
+    _started_pid = os.getpid()
+    threading.Thread(target=_run, daemon=True).start()
+
+def request_flush():
+    start()
+
+def pending(name):
+    return int(store.get_meta('version_' + name, 0)) > int(store.get_meta('mirrored_' + name, 0))
+
+def _lock_path():
+    return store.db_path + '.flush.lock'
+
+def flush():
+    names = [name for name in _savers if pending(name)]
+    if not names:
+        return
+    # one worker uploads at a time; the lock goes with the process, so a crashed worker never holds it
+    with open(_lock_path(), 'a') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return
+        for name in names:
+            # rows written during the upload stay pending for the next flush
+            version = int(store.get_meta('version_' + name, 0))
+            if version > int(store.get_meta('mirrored_' + name, 0)):
+                partitions = store.unmirrored_partitions(name)
+                # rows merged from the gist move the version on without needing an upload
+                if partitions:
+                    _savers[name](partitions)
+                store.mark_mirrored(name, version)
+                metrics.count('partitions_mirrored_total', len(partitions), table=name)
+
+def _run():
+    while True:
+        time.sleep(flush_interval)
+        try:
+            flush()
+        except Exception as e:
+            # leave the rows pending and try again next time, but say so, as a gist that keeps
+            # failing to update otherwise goes unnoticed
+            metrics.count('mirror_failures_total')
+            print('embs: gist upload failed, will retry: ' + repr(e), file=sys.stderr)
@@ -0,0 +1,59 @@
+import pandas as pd
+import store
+import metrics
+
+measurement_columns = [c for c in store.combined_columns if c not in ('Timestamp', 'Method')]
+
+def combine_readings(manual, enviro):
+    # one frame of both Methods, indexed by utc time in order, without repeated rows, and with
+    # float32 measurements and a categorical Method and Device (the kit's uid, '' for manual
+    # readings) to keep it small; the inputs are left as they are
+    with metrics.span('combine_readings'):
+        return _combine_readings(manual, enviro)
+
+def _combine_readings(manual, enviro):
+    parts = []
+    for name, readings in [('manual_readings', manual), ('enviro_readings', enviro)]:
+        readings = readings.rename(columns=store.combined_names[name])
+        part = readings.reindex(columns=measurement_columns).apply(pd.to_numeric, errors='coerce')
+        part = part.astype('float32')
+        part.index = pd.DatetimeIndex(pd.to_datetime(readings['Timestamp'], utc=True), name='Timestamp')
+        part['Method'] = store.methods[name]
+        part['Device'] = readings['uid'].to_numpy() if 'uid' in readings else ''
+        parts.append(part)
+    data = pd.concat(parts)
+    data['Method'] = pd.Categorical(data['Method'], categories=['Manual', 'Enviro'])
+    data['Device'] = data['Device'].astype('category')
+    data = data[data.index.notna()].sort_index(kind='stable')
+    return data[~data.reset_index().duplicated().to_numpy()]
+
+def select_range(data, start=None, end=None):
+    # start and end are inclusive, and either may be left open
+    index = data.index
+    first = 0 if start is None else index.searchsorted(pd.Timestamp(start), side='left')
+    last = len(index) if end is None else index.searchsorted(pd.Timestamp(end), side='right')
+    return data.iloc[first:last]
+
+def columnar(values, bucket=None):
+    # parallel arrays of epoch milliseconds and values, averaged per bucket if asked
+    values = values.dropna().astype('float64')
+    if bucket is not None:
+        values = values.resample(bucket).mean().dropna()
+    return {
+        'timestamp_ms': (values.index.asi8 // 1000000).tolist(),
+        # the store's float32 values are rounded so they do not print as long float64 fractions
+        'value': values.round(4).tolist()
+    }
+
+def to_arrow(series):
+    # series maps Method to a columnar dict; pyarrow is only needed for this format
+    import pyarrow as pa
+    table = pa.table({
+        'method': pa.array([method for method, s in series.items() for _ in s['value']]).dictionary_encode(),
+        'timestamp': pa.array([t for s in series.values() for t in s['timestamp_ms']], pa.timestamp('ms', tz='UTC')),
+        'value': pa.array([v for s in series.values() for v in s['value']], pa.float64())
+    })
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
@@ -0,0 +1,170 @@
+import os
+import io
+import json
+import time
+import pickle
+import threading
+import pandas as pd
+import gist_client
+import metrics
+import singleflight
+
+# seconds a parsed gist file is trusted before GitHub is asked whether it has changed
+cache_ttl = 60
+# shared by all gunicorn workers, so one worker's fetch saves the others a round trip
+cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache')
+
+_memory = {}
+_locks = {}
+_locks_lock = threading.Lock()
+
+def _lock(key):
+    # one lock per gist or file, so different ones can be fetched at the same time
+    with _locks_lock:
+        return _locks.setdefault(key, threading.Lock())
+
+def _cache_paths(gist_id, filename=None):
+    base = os.path.join(cache_dir, gist_id if filename is None else gist_id + '-' + filename)
+    return base + '.json', base + '.pkl'
+
+def _read_meta(meta_path):
+    try:
+        with open(meta_path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _read_data(data_path):
+    try:
+        with open(data_path, 'rb') as f:
+            return pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        return None
+
+def _write_atomic(path, mode, write):
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = path + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp, mode) as f:
+        write(f)
+    os.replace(tmp, path)
+
+def _write_meta(meta_path, etag, checked):
+    _write_atomic(meta_path, 'w', lambda f: json.dump({'etag': etag, 'checked': checked}, f))
+
+def load_gist(gist_id):
+    # the gist's files and revision, from the cache while it is still current
+    key = (gist_id,)
+    with _lock(key):
+        entry = _memory.get(key)
+        if entry is not None and time.time() - entry['checked'] < cache_ttl:
+            metrics.count('cache_requests_total', cache='gist', result='hit')
+            return entry
+        # one worker at a time asks GitHub, and those that waited use its answer
+        with singleflight.flight('gist-' + gist_id):
+            return _fetch_gist(gist_id, entry)
+
+def _fetch_gist(gist_id, entry):
+    key = (gist_id,)
+    meta_path, data_path = _cache_paths(gist_id)
+    now = time.time()
+    meta = _read_meta(meta_path)
+    if meta is not None and now - meta['checked'] < cache_ttl:
+        # another worker has checked with GitHub recently
+        if entry is None or entry['etag'] != meta['etag']:
+            entry = _read_data(data_path)
+        if entry is not None:
+            entry['checked'] = meta['checked']
+            _memory[key] = entry
+            metrics.count('cache_requests_total', cache='gist', result='shared')
+            return entry
+
+    if entry is None and meta is not None:
+        entry = _read_data(data_path)
+
+    gist_response = gist_client.get_gist(gist_id, entry['etag'] if entry is not None else None)
+
+    if gist_response.status_code == 304:
+        # unchanged, so skip the download
+        entry['checked'] = now
+        metrics.count('cache_requests_total', cache='gist', result='not_modified')
+    else:
+        metrics.count('cache_requests_total', cache='gist', result='miss')
+        entry = _entry(gist_response.json(), gist_response.headers.get('ETag'), now)
+        _write_atomic(data_path, 'wb', lambda f: pickle.dump(entry, f))
+    _write_meta(meta_path, entry['etag'], now)
+    _memory[key] = entry
+    return entry
+
+def _entry(gist, etag, checked):
+    return {
+        'etag': etag,
+        'checked': checked,
+        'revision': gist['history'][0]['version'] if gist.get('history') else None,
+        # truncated content is useless, the whole file is fetched from raw_url instead
+        'files': {name: {
+            'raw_url': file['raw_url'],
+            'truncated': file.get('truncated', False),
+            'content': None if file.get('truncated', False) else file['content']}
+            for name, file in gist['files'].items()}
+    }
+
+def remember_gist(gist_id, gist):
+    # the gist as a PATCH returned it, so the next save can start from it without downloading
+    # the whole gist again. GitHub gives no etag with it, so a load once it is no longer current
+    # asks for the whole gist, as it would after any change
+    key = (gist_id,)
+    meta_path, data_path = _cache_paths(gist_id)
+    with _lock(key):
+        entry = _entry(gist, None, time.time())
+        _write_atomic(data_path, 'wb', lambda f: pickle.dump(entry, f))
+        _write_meta(meta_path, None, entry['checked'])
+        _memory[key] = entry
+
+def cached_gist(gist_id):
+    # the gist as any worker last loaded or remembered it, however long ago, or None
+    key = (gist_id,)
+    with _lock(key):
+        entry = _read_data(_cache_paths(gist_id)[1])
+        return entry if entry is not None else _memory.get(key)
+
+def load_gist_text(gist_id, filename):
+    file = load_gist(gist_id)['files'][filename]
+    if file['truncated']:
+        return gist_client.get_raw(file['raw_url'])
+    return file['content']
+
+def load_gist_csv(gist_id, filename):
+    # parsed files are kept until their raw_url, which includes the file's revision, changes
+    key = (gist_id, filename)
+    meta_path, data_path = _cache_paths(gist_id, filename)
+    version = load_gist(gist_id)['files'][filename]['raw_url']
+    with _lock(key):
+        entry = _memory.get(key)
+        if entry is None or entry['version'] != version:
+            entry = _read_data(data_path)
+        if entry is None or entry['version'] != version:
+            with singleflight.flight('csv-' + gist_id + '-' + filename):
+                # parsed by another worker while this one waited
+                entry = _read_data(data_path)
+                if entry is None or entry['version'] != version:
+                    metrics.count('cache_requests_total', cache='csv', result='miss')
+                    text = load_gist_text(gist_id, filename)
+                    with metrics.span('csv_parse'):
+                        entry = {'version': version, 'data': pd.read_csv(io.StringIO(text))}
+                    _write_atomic(data_path, 'wb', lambda f: pickle.dump(entry, f))
+                else:
+                    metrics.count('cache_requests_total', cache='csv', result='shared')
+        else:
+            metrics.count('cache_requests_total', cache='csv', result='hit')
+        _memory[key] = entry
+        return entry['data'].copy()
+
+def invalidate(gist_id):
+    # keep the etag so the next load is still a conditional request
+    meta_path, data_path = _cache_paths(gist_id)
+    with _lock((gist_id,)):
+        entry = _memory.pop((gist_id,), None)
+        if entry is None:
+            entry = _read_meta(meta_path)
+        if entry is not None:
+            _write_meta(meta_path, entry['etag'], 0)
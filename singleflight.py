@@ -0,0 +1,26 @@
+import os
+import fcntl
+import threading
+import contextlib
+
+# lock files through which gunicorn workers wait on work being done in another worker
+lock_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'locks')
+
+_locks = {}
+_locks_lock = threading.Lock()
+
+def thread_lock(name):
+    # one lock per name, so different work can go on at the same time
+    with _locks_lock:
+        return _locks.setdefault(name, threading.Lock())
+
+@contextlib.contextmanager
+def flight(name):
+    # the named work is done by one caller at a time, in this process or any other; callers
+    # that had to wait should look again for its result before doing the work themselves
+    with thread_lock(name):
+        os.makedirs(lock_dir, exist_ok=True)
+        with open(os.path.join(lock_dir, name + '.lock'), 'a') as lock:
+            # released when the file is closed, or if the process dies
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
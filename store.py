@@ -0,0 +1,625 @@
+import os
+import sys
+import json
+import sqlite3
+import contextlib
+import threading
+import pandas as pd
+
+# local copy of all readings; the gists are kept as a backup of this
+db_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'embs.db')
+
+# column order matches the csv files in the gists, timestamp first
+tables = {
+    'enviro_readings': ['timestamp', 'temperature', 'humidity', 'pressure', 'noise', 'pm1', 'pm2_5', 'pm10'],
+    'manual_readings': ['Timestamp', 'Temperature', 'Humidity', 'AQI', 'PM2.5', 'PM10', 'TVOC'],
+}
+
+# the Enviro models whose readings fit the enviro_readings columns
+device_models = ['urban']
+# kits allowed to send readings, as (uid, nickname, model), when the store is created;
+# more are added with python store.py add-device <uid> <nickname> <model>
+default_devices = [('e6614103e75c6322', 'embsgarden', 'urban')]
+
+# text columns kept after the readings to say which kit each came from, with the value given to
+# rows without one; everything from before the uid was kept came from the garden kit.
+# A table's readings are partitioned by its uid, if it has one
+source_columns = {
+    'enviro_readings': {'uid': default_devices[0][0]},
+    'manual_readings': {},
+}
+# a reading is only stored once per key, so a kit sending the same readings again is harmless
+unique_keys = {'enviro_readings': ['uid', 'timestamp'], 'manual_readings': None}
+
+# how each table's columns are named once the two are combined, and which Method it is
+combined_names = {
+    'enviro_readings': {'timestamp': 'Timestamp', 'temperature': 'Temperature', 'humidity': 'Humidity',
+        'pressure': 'Pressure', 'noise': 'Noise', 'pm1': 'PM1', 'pm2_5': 'PM2.5', 'pm10': 'PM10'},
+    'manual_readings': {c: c for c in tables['manual_readings']},
+}
+methods = {'enviro_readings': 'Enviro', 'manual_readings': 'Manual'}
+combined_columns = ['Timestamp', 'Temperature', 'Humidity', 'AQI', 'PM2.5', 'PM10', 'TVOC',
+    'Method', 'Pressure', 'Noise', 'PM1']
+
+# comparisons read_page can filter by
+filter_operators = ['=', '!=', '<', '<=', '>', '>=', 'contains', 'startswith']
+
+# each period maps utc iso timestamps to the start of the bucket they fall in
+rollup_periods = {
+    'hour': lambda timestamp: timestamp.str[:13] + ':00:00Z',
+    'day': lambda timestamp: timestamp.str[:10] + 'T00:00:00Z',
+}
+
+_local = threading.local()
+
+def _quote(name):
+    return '"' + name + '"'
+
+def _columns(name):
+    return tables[name] + list(source_columns[name])
+
+def _text_default(value):
+    return "TEXT NOT NULL DEFAULT '" + value.replace("'", "''") + "'"
+
+def _has_devices(name):
+    return 'uid' in source_columns[name]
+
+def _devices_of(name, data):
+    # the device of each row, or '' for tables without devices
+    if _has_devices(name):
+        return data['uid']
+    return pd.Series('', index=data.index, dtype=object)
+
+def _partitions(name, data):
+    # the (device, month) partitions the rows fall in
+    return set(zip(_devices_of(name, data), data[tables[name][0]].str[:7]))
+
+_rollups_table = ('CREATE TABLE IF NOT EXISTS rollups (name TEXT NOT NULL, device TEXT NOT NULL, '
+    'metric TEXT NOT NULL, period TEXT NOT NULL, bucket TEXT NOT NULL, count INTEGER, min REAL, max REAL, '
+    'sum REAL, last REAL, last_timestamp TEXT, PRIMARY KEY (name, period, metric, device, bucket))')
+
+def connect():
+    # one connection per thread, and never one inherited from a parent process
+    con = getattr(_local, 'con', None)
+    if con is None or _local.pid != os.getpid():
+        con = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+        con.execute('PRAGMA journal_mode=WAL')
+        con.execute('PRAGMA synchronous=NORMAL')
+        _create_tables(con)
+        _local.con = con
+        _local.pid = os.getpid()
+    return con
+
+def _create_tables(con):
+    for name, columns in tables.items():
+        con.execute('CREATE TABLE IF NOT EXISTS ' + name + ' ('
+            + _quote(columns[0]) + ' TEXT NOT NULL, '
+            + ', '.join([_quote(c) + ' REAL' for c in columns[1:]]
+                + [_quote(c) + ' ' + _text_default(d) for c, d in source_columns[name].items()]) + ')')
+        con.execute('CREATE INDEX IF NOT EXISTS ' + name + '_timestamp ON '
+            + name + ' (' + _quote(columns[0]) + ')')
+    con.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+    # summaries of each reading per device per hour and per day, kept up to date as rows are written
+    con.execute(_rollups_table)
+    # each device's months with writes that have not reached the gist yet, and the version
+    # they were written at
+    con.execute('CREATE TABLE IF NOT EXISTS unmirrored_partitions (name TEXT NOT NULL, device TEXT NOT NULL, '
+        'month TEXT NOT NULL, version INTEGER, PRIMARY KEY (name, device, month))')
+    # the kits allowed to send readings
+    con.execute('CREATE TABLE IF NOT EXISTS devices (uid TEXT PRIMARY KEY, nickname TEXT NOT NULL, '
+        'model TEXT NOT NULL)')
+    _migrate(con, 'source_columns_added', _add_source_columns)
+    _migrate(con, 'rollups_built', _build_rollups)
+    _migrate(con, 'device_partitions_built', _build_device_partitions)
+    _migrate(con, 'unique_keys_built', _build_unique_keys)
+
+def _migrate(con, key, step):
+    # runs step once per database, by whichever worker gets there first
+    if _get_meta(con, key) is not None:
+        return
+    con.execute('BEGIN IMMEDIATE')
+    try:
+        if _get_meta(con, key) is None:
+            step(con)
+            set_meta(con, key, 1)
+        con.execute('COMMIT')
+    except Exception:
+        con.execute('ROLLBACK')
+        raise
+
+def _build_rollups(con):
+    for name in tables:
+        _rebuild_rollups(con, name, _read_all(con, name))
+
+def _add_source_columns(con):
+    # stores from before the uid was kept gain the column
+    for name in tables:
+        existing = [row[1] for row in con.execute('PRAGMA table_info(' + name + ')')]
+        for c, default in source_columns[name].items():
+            if c not in existing:
+                con.execute('ALTER TABLE ' + name + ' ADD COLUMN ' + _quote(c) + ' ' + _text_default(default))
+
+def _build_device_partitions(con):
+    # stores from before there was more than one kit have their rollups and pending uploads split by device
+    if 'device' not in [row[1] for row in con.execute('PRAGMA table_info(rollups)')]:
+        con.execute('DROP TABLE rollups')
+        con.execute(_rollups_table)
+        _build_rollups(con)
+    if con.execute("SELECT 1 FROM sqlite_master WHERE name = 'unmirrored_months'").fetchone() is not None:
+        # a device of '' stands for every device's readings in the month
+        con.execute("INSERT OR REPLACE INTO unmirrored_partitions SELECT name, '', month, version "
+            "FROM unmirrored_months")
+        con.execute('DROP TABLE unmirrored_months')
+    con.executemany('INSERT OR IGNORE INTO devices VALUES (?, ?, ?)', default_devices)
+
+def _build_unique_keys(con):
+    # stores from before the uid was kept lose any repeated readings, and then refuse new repeats
+    for name, key in unique_keys.items():
+        if key is not None:
+            _deduplicate(con, name)
+            con.execute('CREATE UNIQUE INDEX IF NOT EXISTS ' + name + '_key ON '
+                + name + ' (' + ', '.join(_quote(c) for c in key) + ')')
+
+def _deduplicate(con, name):
+    # keeps the first of each key; the months that lost rows are queued to be written to the gist
+    repeats = ('FROM ' + name + ' WHERE rowid NOT IN (SELECT MIN(rowid) FROM ' + name + ' GROUP BY '
+        + ', '.join(_quote(c) for c in unique_keys[name]) + ')')
+    removed = pd.read_sql_query('SELECT ' + ', '.join(_quote(c) for c in _columns(name)) + ' ' + repeats, con)
+    if len(removed) == 0:
+        return 0
+    con.execute('DELETE ' + repeats)
+    timestamp = removed[tables[name][0]]
+    _rebuild_rollups(con, name, _read_all(con, name),
+        {period: bucket(timestamp).unique().tolist() for period, bucket in rollup_periods.items()})
+    _mark_rewritten(con, name, _bump_version(con, name, _partitions(name, removed)))
+    return len(removed)
+
+def _prepare(name, data):
+    # timestamps are stored as utc iso strings so that they sort correctly as text
+    columns = tables[name]
+    data = data.reindex(columns=_columns(name))
+    data[columns[0]] = pd.to_datetime(data[columns[0]], utc=True, errors='coerce')
+    data = data[data[columns[0]].notna()].copy()
+    data[columns[0]] = data[columns[0]].dt.strftime('%Y-%m-%dT%H:%M:%SZ')
+    for c in columns[1:]:
+        data[c] = pd.to_numeric(data[c], errors='coerce')
+    for c, default in source_columns[name].items():
+        data[c] = data[c].where(data[c].notna(), default).astype(str)
+    return data
+
+def _insert(con, name, data):
+    # returns the rows that were stored; any whose key is already held are skipped,
+    # each found with one lookup in the unique index
+    columns = _columns(name)
+    sql = ('INSERT OR IGNORE INTO ' + name + ' (' + ', '.join(_quote(c) for c in columns)
+        + ') VALUES (' + ', '.join('?' * len(columns)) + ')')
+    rows = data[columns].astype(object).where(data[columns].notna(), None).itertuples(index=False, name=None)
+    if unique_keys[name] is None:
+        con.executemany(sql, rows)
+        return data
+    return data.iloc[[i for i, row in enumerate(rows) if con.execute(sql, row).rowcount == 1]]
+
+def _read_all(con, name):
+    return pd.read_sql_query('SELECT ' + ', '.join(_quote(c) for c in _columns(name))
+        + ' FROM ' + name, con)
+
+def _summarise(name, data, periods=None):
+    # one row per device per metric per bucket of each of periods (all of them if None),
+    # in the layout of the rollups table
+    timestamp = tables[name][0]
+    data = data[tables[name]].assign(device=_devices_of(name, data)).sort_values(timestamp, kind='stable')
+    long = data.melt(id_vars=[timestamp, 'device'], var_name='metric').dropna(subset=['value'])
+    summaries = []
+    for period in periods or rollup_periods:
+        bucket = rollup_periods[period]
+        summary = long.assign(bucket=bucket(long[timestamp])).groupby(['device', 'metric', 'bucket'], sort=False).agg(
+            count=('value', 'size'), min=('value', 'min'), max=('value', 'max'),
+            sum=('value', 'sum'), last=('value', 'last'), last_timestamp=(timestamp, 'last')).reset_index()
+        summary.insert(0, 'period', period)
+        summaries.append(summary)
+    summary = pd.concat(summaries)
+    summary.insert(0, 'name', name)
+    return summary[['name', 'device', 'metric', 'period', 'bucket', 'count', 'min', 'max', 'sum', 'last',
+        'last_timestamp']]
+
+def _add_to_rollups(con, name, data, periods=None):
+    # merge the new rows into the existing buckets
+    con.executemany('INSERT INTO rollups VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) '
+        'ON CONFLICT (name, period, metric, device, bucket) DO UPDATE SET '
+        'count = rollups.count + excluded.count, '
+        'min = min(rollups.min, excluded.min), '
+        'max = max(rollups.max, excluded.max), '
+        'sum = rollups.sum + excluded.sum, '
+        'last = CASE WHEN excluded.last_timestamp >= rollups.last_timestamp '
+        'THEN excluded.last ELSE rollups.last END, '
+        'last_timestamp = max(rollups.last_timestamp, excluded.last_timestamp)',
+        _summarise(name, data, periods).astype(object).itertuples(index=False, name=None))
+
+def _rebuild_rollups(con, name, data, buckets=None):
+    # buckets maps period to the bucket starts to recompute, or None for all of them
+    if buckets is None:
+        con.execute('DELETE FROM rollups WHERE name = ?', (name,))
+        _add_to_rollups(con, name, data)
+        return
+    # each period separately, as a day being recomputed does not mean its hours are
+    timestamp = tables[name][0]
+    for period, bucket in rollup_periods.items():
+        con.executemany('DELETE FROM rollups WHERE name = ? AND period = ? AND bucket = ?',
+            [(name, period, b) for b in buckets[period]])
+        _add_to_rollups(con, name, data[bucket(data[timestamp]).isin(buckets[period])], [period])
+
+def _get_meta(con, key, default=None):
+    row = con.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+    return default if row is None else row[0]
+
+def get_meta(key, default=None):
+    return _get_meta(connect(), key, default)
+
+def set_meta(con, key, value):
+    con.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, str(value)))
+
+def _bump_version(con, name, partitions=None):
+    # every write moves the version on, so readers and the gist mirror can tell what changed;
+    # partitions are the (device, month) pairs written to, which need mirroring
+    version = int(_get_meta(con, 'version_' + name, 0)) + 1
+    set_meta(con, 'version_' + name, version)
+    if partitions is not None:
+        con.executemany('INSERT OR REPLACE INTO unmirrored_partitions VALUES (?, ?, ?, ?)',
+            [(name, device, month, version) for device, month in partitions])
+    return version
+
+def _mark_rewritten(con, name, version):
+    # rows were changed or removed rather than added, so anything following the table's
+    # new rows must read it again from the start
+    set_meta(con, 'rewritten_' + name, version)
+
+def data_version(name):
+    return int(get_meta('version_' + name, 0))
+
+def is_seeded(name):
+    return get_meta('seeded_' + name) is not None
+
+def ensure_seeded(name, load):
+    # copy existing history from the gist the first time the store is used
+    key = 'seeded_' + name
+    if is_seeded(name):
+        return
+    con = connect()
+    con.execute('BEGIN IMMEDIATE')
+    try:
+        if _get_meta(con, key) is None:
+            data = _prepare(name, load())
+            inserted = _insert(con, name, data)
+            _add_to_rollups(con, name, inserted)
+            set_meta(con, key, 1)
+            # the gist already holds these rows, so they do not need mirroring
+            set_meta(con, 'mirrored_' + name, _bump_version(con, name))
+            if len(inserted) < len(data):
+                # except where it holds repeated readings, which are written again without them
+                _bump_version(con, name, _partitions(name, data.loc[~data.index.isin(inserted.index)]))
+        con.execute('COMMIT')
+    except Exception:
+        con.execute('ROLLBACK')
+        raise
+
+def append_readings(name, data):
+    # returns how many rows were stored, leaving out readings that are already held
+    return append_batches(name, [data])[0]
+
+def append_batches(name, batches):
+    # several frames of readings written in one transaction; returns how many rows of each were stored
+    batches = [_prepare(name, data) for data in batches]
+    con = connect()
+    con.execute('BEGIN IMMEDIATE')
+    try:
+        batches = [_insert(con, name, data) for data in batches]
+        data = pd.concat(batches) if batches else pd.DataFrame(columns=_columns(name))
+        if len(data) > 0:
+            _add_to_rollups(con, name, data)
+            _bump_version(con, name, _partitions(name, data))
+        con.execute('COMMIT')
+    except Exception:
+        con.execute('ROLLBACK')
+        raise
+    return [len(data) for data in batches]
+
+def merge_readings(name, data):
+    # adds the rows of another copy of the table that the store does not hold yet, without
+    # queuing them for the gist, which has them already; returns how many were added
+    data = _prepare(name, data)
+    con = connect()
+    con.execute('BEGIN IMMEDIATE')
+    try:
+        if unique_keys[name] is None:
+            # without a key, a row identical to one held is taken to be the same reading
+            columns = _columns(name)
+            held = _read_all(con, name)
+            held = held.assign(occurrence=held.groupby(columns, dropna=False).cumcount())
+            data = data.assign(occurrence=data.groupby(columns, dropna=False).cumcount())
+            data = pd.concat([held, held, data]).drop_duplicates(keep=False).drop(columns=['occurrence'])
+        data = _insert(con, name, data)
+        if len(data) > 0:
+            _add_to_rollups(con, name, data)
+            _bump_version(con, name)
+        con.execute('COMMIT')
+    except Exception:
+        con.execute('ROLLBACK')
+        raise
+    return len(data)
+
+def edit_readings(name, changed, deleted):
+    # changed holds new values for rows, with the rowid of each, and deleted the rowids of rows
+    # to remove; only those rows, and the rollup buckets holding them, are read and written again
+    rowids = changed['rowid'].astype(int)
+    changed = _prepare(name, changed)
+    # a row whose timestamp is not valid is left as it was
+    rowids = rowids.loc[changed.index].tolist()
+    deleted = [int(rowid) for rowid in deleted]
+    columns = _columns(name)
+    con = connect()
+    con.execute('BEGIN IMMEDIATE')
+    try:
+        touched = rowids + deleted
+        old = pd.read_sql_query('SELECT ' + ', '.join(_quote(c) for c in columns) + ' FROM ' + name
+            + ' WHERE rowid IN (' + ', '.join('?' * len(touched)) + ')', con, params=touched)
+        con.executemany('UPDATE ' + name + ' SET ' + ', '.join(_quote(c) + ' = ?' for c in columns)
+            + ' WHERE rowid = ?', [row + (rowid,) for row, rowid in zip(
+                changed[columns].astype(object).where(changed[columns].notna(), None).itertuples(index=False, name=None),
+                rowids)])
+        con.executemany('DELETE FROM ' + name + ' WHERE rowid = ?', [(rowid,) for rowid in deleted])
+        timestamp = pd.concat([old, changed])[tables[name][0]]
+        days = rollup_periods['day'](timestamp).unique().tolist()
+        _rebuild_rollups(con, name, _read_days(con, name, days),
+            {period: bucket(timestamp).unique().tolist() for period, bucket in rollup_periods.items()})
+        _mark_rewritten(con, name, _bump_version(con, name, _partitions(name, pd.concat([old, changed]))))
+        con.execute('COMMIT')
+    except Exception:
+        con.execute('ROLLBACK')
+        raise
+    return len(touched)
+
+def _read_days(con, name, days):
+    # every row in the days starting at the given day buckets
+    timestamp = _quote(tables[name][0])
+    if not days:
+        return _read_all(con, name).head(0)
+    return pd.read_sql_query('SELECT ' + ', '.join(_quote(c) for c in _columns(name)) + ' FROM ' + name
+        + ' WHERE ' + ' OR '.join([timestamp + ' BETWEEN ? AND ?'] * len(days)), con,
+        params=[t for day in days for t in (day, day[:10] + 'T23:59:59Z')])
+
+def read_page(name, offset, limit, order=None, filters=None):
+    # a page of rows, with the rowid of each, and how many rows there are to page through;
+    # order is a list of (column, ascending), and filters a list of (column, operator, value)
+    # with an operator from filter_operators
+    columns = _columns(name)
+    clauses = []
+    params = []
+    for column, operator, value in filters or []:
+        if column not in columns or operator not in filter_operators:
+            raise ValueError('cannot filter ' + str(column) + ' by ' + str(operator))
+        if operator == 'contains':
+            clauses.append('instr(CAST(' + _quote(column) + ' AS TEXT), ?) > 0')
+            params.append(str(value))
+        elif operator == 'startswith':
+            clauses.append('substr(CAST(' + _quote(column) + ' AS TEXT), 1, ?) = ?')
+            params.extend([len(str(value)), str(value)])
+        else:
+            clauses.append(_quote(column) + ' ' + operator + ' ?')
+            params.append(value)
+    where = ' WHERE ' + ' AND '.join(clauses) if clauses else ''
+    sorts = []
+    for column, ascending in order or []:
+        if column not in columns:
+            raise ValueError('cannot sort by ' + str(column))
+        sorts.append(_quote(column) + (' ASC' if ascending else ' DESC'))
+    con = connect()
+    total = con.execute('SELECT COUNT(*) FROM ' + name + where, params).fetchone()[0]
+    data = pd.read_sql_query('SELECT rowid, ' + ', '.join(_quote(c) for c in columns) + ' FROM ' + name
+        + where + ' ORDER BY ' + ', '.join(sorts + ['rowid']) + ' LIMIT ? OFFSET ?', con,
+        params=params + [limit, offset])
+    return data, total
+
+def read_readings(name, start=None, end=None, devices=None):
+    # start and end are inclusive utc iso strings, and use the timestamp index;
+    # devices limits the rows to those uids, in tables with devices
+    timestamp = _quote(tables[name][0])
+    clauses = []
+    params = []
+    if devices is not None and _has_devices(name):
+        clauses.append('uid IN (' + ', '.join('?' * len(devices)) + ')')
+        params.extend(devices)
+    if start is not None:
+        clauses.append(timestamp + ' >= ?')
+        params.append(start)
+    if end is not None:
+        clauses.append(timestamp + ' <= ?')
+        params.append(end)
+    sql = 'SELECT ' + ', '.join(_quote(c) for c in _columns(name)) + ' FROM ' + name
+    if clauses:
+        sql += ' WHERE ' + ' AND '.join(clauses)
+    # manual readings keep the order they were entered in, for the edit table
+    sql += ' ORDER BY ' + (timestamp if name == 'enviro_readings' else 'rowid')
+    return pd.read_sql_query(sql, connect(), params=params)
+
+def partitions(name, month=None):
+    # the (device, month) pairs holding readings, optionally only in one month
+    timestamp = _quote(tables[name][0])
+    sql = ('SELECT DISTINCT ' + ('uid' if _has_devices(name) else "''") + ', substr(' + timestamp
+        + ', 1, 7) AS month FROM ' + name)
+    params = []
+    if month is not None:
+        sql += ' WHERE ' + timestamp + ' >= ? AND ' + timestamp + ' <= ?'
+        params = [month + '-01T00:00:00Z', month + '-31T23:59:59Z']
+    return [tuple(row) for row in connect().execute(sql + ' ORDER BY 2, 1', params)]
+
+def read_partition(name, device, period):
+    # period is YYYY-MM, or YYYY for the whole year; day 31 is past the end of every month when
+    # compared as text
+    start, end = (period + '-01-01', period + '-12-31') if len(period) == 4 else (period + '-01', period + '-31')
+    return read_readings(name, start + 'T00:00:00Z', end + 'T23:59:59Z', [device] if _has_devices(name) else None)
+
+def unmirrored_partitions(name):
+    # a device of '' in a table with devices is every device's readings in the month, as pending
+    # uploads were kept before there were devices; it stands for the month's undivided partition too
+    pending = []
+    for device, month in connect().execute('SELECT device, month FROM unmirrored_partitions '
+            'WHERE name = ? ORDER BY month, device', (name,)):
+        if device == '' and _has_devices(name):
+            pending.extend(partitions(name, month))
+        pending.append((device, month))
+    return sorted(set(pending), key=lambda partition: (partition[1], partition[0]))
+
+def mark_mirrored(name, version):
+    # months written again since version stay waiting for the next upload
+    con = connect()
+    con.execute('BEGIN IMMEDIATE')
+    try:
+        set_meta(con, 'mirrored_' + name, version)
+        con.execute('DELETE FROM unmirrored_partitions WHERE name = ? AND version <= ?', (name, version))
+        con.execute('COMMIT')
+    except Exception:
+        con.execute('ROLLBACK')
+        raise
+
+@contextlib.contextmanager
+def reading():
+    # everything read inside sees the store as it was at one moment, whatever other processes write
+    con = connect()
+    if con.in_transaction:
+        yield con
+        return
+    con.execute('BEGIN')
+    try:
+        yield con
+    finally:
+        con.execute('COMMIT')
+
+def position(name):
+    # the version and the number of the newest row; rows are numbered in the order they are
+    # added, so later rows can be found until the table is rewritten
+    with reading() as con:
+        version = int(_get_meta(con, 'version_' + name, 0))
+        row = con.execute('SELECT COALESCE(MAX(rowid), 0) FROM ' + name).fetchone()[0]
+    return [version, row]
+
+def rewritten(name):
+    # the last version at which rows were changed or removed
+    return int(get_meta('rewritten_' + name, 0))
+
+def read_since(name, row, devices=None):
+    # the rows added after row, in the order they were added, with the number of each in rowid
+    sql = ('SELECT rowid, ' + ', '.join(_quote(c) for c in _columns(name)) + ' FROM ' + name
+        + ' WHERE rowid > ?')
+    params = [row]
+    if devices is not None and _has_devices(name):
+        sql += ' AND uid IN (' + ', '.join('?' * len(devices)) + ')'
+        params.extend(devices)
+    return pd.read_sql_query(sql + ' ORDER BY rowid', connect(), params=params)
+
+def count_readings(name):
+    return connect().execute('SELECT COUNT(*) FROM ' + name).fetchone()[0]
+
+def count_buckets(name, period):
+    return connect().execute('SELECT COUNT(DISTINCT bucket) FROM rollups WHERE name = ? AND period = ?',
+        (name, period)).fetchone()[0]
+
+def read_rollups(name, period, start=None, end=None):
+    # one row per device per metric per bucket, with the mean worked out from the running sum
+    sql = ('SELECT device, metric, bucket, count, min, max, sum / count AS mean, last FROM rollups '
+        'WHERE name = ? AND period = ?')
+    params = [name, period]
+    if start is not None:
+        sql += ' AND bucket >= ?'
+        params.append(start)
+    if end is not None:
+        sql += ' AND bucket <= ?'
+        params.append(end)
+    return pd.read_sql_query(sql + ' ORDER BY bucket', connect(), params=params)
+
+def iter_combined_readings(start=None, end=None, method=None, metrics=None, devices=None, chunk_size=1000):
+    # yields chunks of rows from both tables in timestamp order, as the timestamp, Method, the kit's
+    # uid ('' for tables without devices) and metrics, without holding more than one chunk in memory;
+    # devices limits the rows to those uids, in tables with devices
+    metrics = metrics or [c for c in combined_columns if c not in ('Timestamp', 'Method')]
+    selects = []
+    params = []
+    for name, names in combined_names.items():
+        if method is not None and methods[name] != method:
+            continue
+        columns = {combined: _quote(column) for column, combined in names.items()}
+        if not any(m in columns for m in metrics):
+            continue
+        timestamp = columns['Timestamp']
+        clauses = ['(' + ' OR '.join(columns[m] + ' IS NOT NULL' for m in metrics if m in columns) + ')']
+        params.append(methods[name])
+        if start is not None:
+            clauses.append(timestamp + ' >= ?')
+            params.append(start)
+        if end is not None:
+            clauses.append(timestamp + ' <= ?')
+            params.append(end)
+        if devices is not None and _has_devices(name):
+            clauses.append('uid IN (' + ', '.join('?' * len(devices)) + ')')
+            params.extend(devices)
+        selects.append('SELECT ' + timestamp + ', ?, ' + ('uid' if _has_devices(name) else "''") + ', '
+            + ', '.join(columns.get(m, 'NULL') for m in metrics)
+            + ' FROM ' + name + ' WHERE ' + ' AND '.join(clauses))
+    if not selects:
+        return
+    # a separate connection, as the rows are read after the request has been handled
+    con = sqlite3.connect(db_path, timeout=30)
+    try:
+        cursor = con.execute(' UNION ALL '.join(selects) + ' ORDER BY 1', params)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        con.close()
+
+def compact():
+    # one-off clean up: drops repeated readings from the store and queues every month to be
+    # written to the gists again, so their copies lose the repeats too; returns rows removed
+    con = connect()
+    con.execute('BEGIN IMMEDIATE')
+    try:
+        removed = {}
+        for name, key in unique_keys.items():
+            if key is None:
+                continue
+            removed[name] = _deduplicate(con, name)
+            _bump_version(con, name, partitions(name))
+        con.execute('COMMIT')
+    except Exception:
+        con.execute('ROLLBACK')
+        raise
+    con.execute('VACUUM')
+    return removed
+
+def read_devices():
+    return pd.read_sql_query('SELECT uid, nickname, model FROM devices ORDER BY nickname', connect())
+
+def register_device(uid, nickname, model):
+    # adds a kit, or renames it or changes its model if its uid is already known
+    if model not in device_models:
+        raise ValueError('model must be one of ' + ', '.join(device_models))
+    connect().execute('INSERT OR REPLACE INTO devices VALUES (?, ?, ?)', (uid, nickname, model))
+
+usage = '''usage: python store.py compact
+       python store.py devices
+       python store.py add-device <uid> <nickname> <model>'''
+
+if __name__ == '__main__':
+    command = sys.argv[1:]
+    if command == ['compact']:
+        print(json.dumps({'removed': compact()}))
+    elif command == ['devices']:
+        print(read_devices().to_json(orient='records'))
+    elif len(command) == 4 and command[0] == 'add-device':
+        try:
+            register_device(*command[1:])
+        except ValueError as e:
+            sys.exit(str(e))
+    else:
+        sys.exit(usage)